@@ -1,112 +1,104 @@
 import PySimpleGUI as sg
 import time
+import queue
 from datetime import datetime
 from multiprocessing.pool import ThreadPool
 from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
-from omnipy import control, collection, analysis, utils
+from omnipy import control, collection, analysis, utils, acquisition, sweep, bus as omnibus
 from datetime import datetime
 from multiprocessing import Process, Queue
 from pyfirmata import Arduino
 
-controlQue = Queue()
-reportQue = Queue()
-stateQue = Queue()
-DC = control.DC_PSU()
-
-plt.ion()
-
-err= {'err':0,'txt':''}
-
-dbKeys = open('secrets.txt', 'r')
-Lines = dbKeys.readlines()
-
-dbSync = utils.db_tools(Lines[1].strip(), Lines[0].strip(), 'Log_data')
-
 
 def psuLoggingStart(port,voltage,current):
 
     if float(values['-PSUV-']) > 12:
         raise Exception('Supply Limit Requested exceeds soft limit (12V)')
-    psu_operation = pool.apply_async(collection.PSU_run, (dbSync,DC,port,voltage,current,1,controlQue,reportQue))
+    psu_operation = pool.apply_async(collection.PSU_run, (dbSync,DC,port,voltage,current,1,bus.channel('psu '+port)))
 
 
 def runSetup(fig_agg1):
     print('before run def')
-    def run(Vstart, Vstop, Vstep, step, timeout):
+    channel = bus.channel('run')
+    psuErr = 0
+
+    def should_stop(msg):
+        # commands from the GUI, and PSU faults it forwards
+        nonlocal psuErr
+        if msg.command == 'stop':
+            print('stop event')
+            errDump.write('Stop event, %s\n'%msg.args.get('reason', 'user stop'))
+            return True
+        if msg.command in ('fault', 'terminal_fault'):
+            psuErr += 1
+            errDump.write(msg.args['text']+'\n')
+            fig_tool.LogDisp('-LOG-',msg.args['text'])
+            return psuErr > 3
+        return False
+
+    def run(sweep, timeout):
         camDelay = float(values['-CAMDELAY-'])*1e-3
         pulseTime = 5e-3
         start = time.time()
-        ignition = 0
-        while True:
-            
-            time.sleep(0.1)
-            
-            currentVolts = 5*(voltInPin.read()/2**10)*1e5
-            print((time.time()-start) > timeout,currentVolts)
-
-            if currentVolts > Vstart or (time.time()-start) > timeout:
-                    print('sequance start')
-                    
-                    camPin.write(1)
-                    time.sleep(pulseTime)
-                    camPin.write(0)
-                    print('camPulse')
-
-                    time.sleep(camDelay)
-
-                    ignPin.write(1)
-                    time.sleep(pulseTime)
-                    ignPin.write(0)
-                    print('ignPulse')
+        for index, step, shot in sweep.shots():
+            fire = False
+            while not fire:
+                msg = channel.recv(timeout=0.1)
+                if msg is not None and should_stop(msg):
+                    channel.reply('stopped')
+                    return
+                
+                currentVolts = 5*(voltInPin.read()/2**10)*1e5
+                print((time.time()-start) > timeout,currentVolts)
+                fire = currentVolts > step.voltage or (time.time()-start) > timeout
 
-                    ignition += 1
-                    try:
-                        b, bit = analysis.Raw_Data_Collection(disp_sensor,6,freqLaser, ax, cx) # Displasment Sesor Procseeing
-                        fig_agg1.draw()
-                    except:
-                        bit = 0
-                    
-                    fig_tool.LogDisp('-BIT-', bit)
-                    fig_tool.LogDisp('-LASTV-', currentVolts)
-                    fig_tool.LogDisp('-SHOTN-', ignition)
-                    fig_tool.LogDisp('-SENSORH-', 0)
-                    dbSync.db_write('Bit_test', 'test', bit)
+            worker = acq # the GUI drops it if the worker exits
+            if worker is None:
+                errDump.write('Stop event, acquisition worker closed\n')
+                channel.reply('stopped')
+                return
 
-                    start = time.time()
+            print('sequance start')
+            
+            camPin.write(1)
+            worker.send('mark', label='cam', t=time.time())
+            time.sleep(pulseTime)
+            camPin.write(0)
+            print('camPulse')
+
+            time.sleep(camDelay)
+
+            ignPin.write(1)
+            ignTime = time.time()
+            time.sleep(pulseTime)
+            ignPin.write(0)
+            print('ignPulse')
+
+            ignition = sweep.shots_done + 1
+            # The acquisition process finds the discharge and analyses it, the
+            # result comes back to the GUI loop as a 'shot' reply
+            worker.send('shot', shot=ignition, value=currentVolts, t=ignTime)
+            sweep.record(voltage=currentVolts, shot=ignition)
+            
+            fig_tool.LogDisp('-LASTV-', currentVolts)
+            fig_tool.LogDisp('-SHOTN-', ignition)
+            fig_tool.LogDisp('-SENSORH-', 0)
 
-                
-                    stop = False
-                    if ignition >= step:
-                        print('stop event')
-                        errDump.write('\nStop event, user or ignition max exit\nIgnition No.'+str(ignition)+'Ignition max'+str(step)+'\n')
-                        controlQue.put('stop')
-                        stop = True
-                    if not reportQue.empty():
-                        print('stop event')
-                        statment = reportQue.get()
-
-                        psuErr += 1
-                        errDump.write(statment+'\n')
-                        if psuErr > 3:
-                            fig_tool.LogDisp('-LOG-',statment)
-                            stop = True
-                        fig_tool.LogDisp('-LOG-',statment)
-                    if not controlQue.empty():
-                        print('stop event')
-                        errDump.write('Stop event, control que break\n')
-                        if 'stop' in controlQue.get():
-                            stop = True
-                    if stop:
-                        stateQue.put('stop')
-                        break
+            start = time.time()
 
-            
-            if Vstop != Vstart:
-                Vstart += Vstep
-                run(Vstart,Vstop,Vstep,step)
+            stop = False
+            msg = channel.poll()
+            while msg is not None:
+                stop = should_stop(msg) or stop
+                msg = channel.poll()
+            if stop:
+                channel.reply('stopped')
+                return
 
-        return   
+        print('stop event')
+        errDump.write('\nStop event, sweep complete\n'+sweep.summary()+'\n')
+        channel.reply('stopped')
 
     print('after run def')    
     err = ''
@@ -131,156 +123,240 @@ def runSetup(fig_agg1):
     now = datetime.now()
     date_time = now.strftime("%m/%d/%Y, %H:%M:%S")
     errDump.write('\nTest Date/time'+date_time)
+    # The ILD is handed over to the acquisition process for the run, which
+    # keeps the whole stream on disk so shots can be re-analysed later
+    global disp_sensor, acq, run_dis
+    if disp_sensor != 0:
+        if not run_dis: # -DIS_TEST- is still polling it
+            bus.send('ild', 'stop')
+            bus.remove('ild')
+            async_result2.wait(1)
+            run_dis = True
+        disp_sensor.close()
+        disp_sensor = 0
+        fig_tool.SetLED('-SENS_STATUS-', 'red')
+    if acq is not None:
+        acq.close() # the last run's worker must let go of the port first
+        acq = None
+    acq = acquisition.AcquisitionProcess(bus, values['-COM2-'], now.strftime('ILD_stream_%Y%m%d_%H%M%S'), freqLaser)
+    errDump.write('\nILD stream: '+acq.data_file)
     timeout = float(values['-TIMEOUT-'])
 
     if values['-COM5-'] == 'V-Fix':
         Vstart = int(values['-VOLTS-'])
         step = int(values['-SHOOT-'])
         print(Vstart,step)
-        
-        async_result4 = pool.apply_async(run, (Vstart,Vstart,100,step,timeout))
+        plan = sweep.fixed_plan(Vstart, step)
     elif values['-COM5-'] == 'V-Sweep':
         Vstart = int(values['-SWP_STRT-'])
         Vstop = int(values['SWP_STOP-'])
         Vstep = int(values['SWP_STEP-'])
         step = int(values['-SWP_SHOT-'])
-        async_result4 = pool.apply_async(run, (Vstart,Vstop,Vstart,step,timeout))
+        plan = sweep.sweep_plan(Vstart, Vstop, Vstep, step)
     else:
         raise Exception('Mode value not recognised')
 
+    # Picks up where the last run of the same plan stopped, if it didn't finish
+    test = sweep.Sweep(plan, 'sweep_progress.json')
+    if test.resumed:
+        errDump.write('\nResuming at shot %d of %d'%(test.shots_done+1, test.shots_total))
+        fig_tool.LogDisp('-LOG-', 'Resuming sweep at shot %d of %d'%(test.shots_done+1, test.shots_total))
+    def run_failed(e):
+        # apply_async would otherwise swallow it, and nothing would stop the PSUs
+        errDump.write('\nStop event, run failed: %r\n'%e)
+        channel.reply('stopped')
+
+    async_result4 = pool.apply_async(run, (test, timeout), error_callback=run_failed)
+
+
+
+
+# Everything below only runs in the GUI process. The acquisition worker is
+# started with multiprocessing, which re-imports this file in the new process.
+if __name__=='__main__':
+    bus = omnibus.MessageBus() # one channel per worker, replies come back to the GUI loop
+    DC = control.DC_PSU()
+
+    plt.ion()
+
+    err= {'err':0,'txt':''}
 
+    dbKeys = open('secrets.txt', 'r')
+    Lines = dbKeys.readlines()
 
+    dbSync = utils.db_tools(Lines[1].strip(), Lines[0].strip(), 'Log_data')
 
-instruments = DC.list_available()
-COM_PORTS = []   
-ports = {}
-for instrument in instruments:
-    COM = 'COM'+''.join(x for x in instrument if x.isdigit())
-    COM_PORTS.append(COM)
-    ports[COM] = instrument
+
+    instruments = DC.list_available()
+    COM_PORTS = []   
+    ports = {}
+    for instrument in instruments:
+        COM = 'COM'+''.join(x for x in instrument if x.isdigit())
+        COM_PORTS.append(COM)
+        ports[COM] = instrument
  
 
-voltages = [1500,2000]
-potential_shots = [100,200,300,400,500,600,700,800,900,1000]
-potential_freq = [0.1,0.2,0.3]
-#Last_Image = r'C:\Users\KristianHowgate\OneDrive - omnidea.net\Documents\Work\PFT BBM\BBM Block Diagram.png'
-Last_Ibit = 0.01
-Last_V = 1700
-shots = 137
-heath = 100
-step = 6
-freqLaser=2000
-
-
-
-image_elem = sg.Image(data=utils.get_img_data('2.4.0002.JPG', first=True))
-
-modes = [1500]
-col1 = sg.Col([
-        [sg.Frame('',[[sg.Text('Toggle ADC24'),sg.Button(button_text ='Toggle',size=(15,1),key='-VLOG_EN-')],
-        [sg.Text('Arduino COM Port'), sg.Combo(COM_PORTS,size=(15,22), key='-COM-',enable_events=True)],
-        [sg.Button(button_text ='Connect',size=(15,1),key='-ARDUINO_CON-'),  utils.LEDIndicator('-ARDUINO_STATUS-')],
-        [sg.Text('ILD1420 COM Port'), sg.Combo(COM_PORTS,size=(15,22), key='-COM2-',enable_events=True)],
-        [sg.Button(button_text ='Connect',size=(15,1),key='-SENS_CON-'),  utils.LEDIndicator('-SENS_STATUS-'), sg.Button(button_text ='Test',size=(15,1),key='-DIS_TEST-')],
-        [sg.Text('PSU COM Port'), sg.Combo(COM_PORTS,size=(15,22), key='-COM3-',enable_events=True)],
-        [sg.Button(button_text ='Connect',size=(15,1),key='-PSU_CON-'),  utils.LEDIndicator('-PSU_STATUS-')],
-        [sg.Text('PSU2 COM Port'), sg.Combo(COM_PORTS,size=(15,22), key='-COM4-',enable_events=True)],
-        [sg.Button(button_text ='Connect',size=(15,1),key='-PSU2_CON-'),  utils.LEDIndicator('-PSU2_STATUS-')]])],
-        [sg.Text('Operation Mode'), sg.Combo(['V-Fix','V-Sweep'],size=(15,22), key='-COM5-')],
-        [sg.Text('Camera Pre-Trigger (ms)'), sg.Input(default_text='200',size=(15,22), key='-CAMDELAY-')],
+    voltages = [1500,2000]
+    potential_shots = [100,200,300,400,500,600,700,800,900,1000]
+    potential_freq = [0.1,0.2,0.3]
+    #Last_Image = r'C:\Users\KristianHowgate\OneDrive - omnidea.net\Documents\Work\PFT BBM\BBM Block Diagram.png'
+    Last_Ibit = 0.01
+    Last_V = 1700
+    shots = 137
+    heath = 100
+    step = 6
+    freqLaser=2000
+
+
+
+    image_elem = sg.Image(data=utils.get_img_data('2.4.0002.JPG', first=True))
+
+    modes = [1500]
+    col1 = sg.Col([
+            [sg.Frame('',[[sg.Text('Toggle ADC24'),sg.Button(button_text ='Toggle',size=(15,1),key='-VLOG_EN-')],
+            [sg.Text('Arduino COM Port'), sg.Combo(COM_PORTS,size=(15,22), key='-COM-',enable_events=True)],
+            [sg.Button(button_text ='Connect',size=(15,1),key='-ARDUINO_CON-'),  utils.LEDIndicator('-ARDUINO_STATUS-')],
+            [sg.Text('ILD1420 COM Port'), sg.Combo(COM_PORTS,size=(15,22), key='-COM2-',enable_events=True)],
+            [sg.Button(button_text ='Connect',size=(15,1),key='-SENS_CON-'),  utils.LEDIndicator('-SENS_STATUS-'), sg.Button(button_text ='Test',size=(15,1),key='-DIS_TEST-')],
+            [sg.Text('PSU COM Port'), sg.Combo(COM_PORTS,size=(15,22), key='-COM3-',enable_events=True)],
+            [sg.Button(button_text ='Connect',size=(15,1),key='-PSU_CON-'),  utils.LEDIndicator('-PSU_STATUS-')],
+            [sg.Text('PSU2 COM Port'), sg.Combo(COM_PORTS,size=(15,22), key='-COM4-',enable_events=True)],
+            [sg.Button(button_text ='Connect',size=(15,1),key='-PSU2_CON-'),  utils.LEDIndicator('-PSU2_STATUS-')]])],
+            [sg.Text('Operation Mode'), sg.Combo(['V-Fix','V-Sweep'],size=(15,22), key='-COM5-')],
+            [sg.Text('Camera Pre-Trigger (ms)'), sg.Input(default_text='200',size=(15,22), key='-CAMDELAY-')],
          
-        [sg.TabGroup([[sg.Tab('V-Fix',[[sg.Text('Voltage Selection'), sg.Combo(voltages,default_value= 1500,size=(15,22), key='-VOLTS-',enable_events=True)],
-                                    [sg.Text('Target Shot No.'), sg.Spin(potential_shots,size=(15,22), key='-SHOOT-',enable_events=True)],
-                                    [sg.Text('Fixed Voltage Output (V)'), sg.Input(default_text='12',size=(15,22), key='-PSUV-',enable_events=True)],
-                                    [sg.Text('Fixed Current Limit (mA)'), sg.Input(default_text='50',size=(15,22), key='-PSUA-',enable_events=True)],
-                                    [sg.Text('Power Supply Overide Control'),sg.Button(button_text ='Test',size=(15,1),key='-PSUSET-')]])],
-                    [sg.Tab('V-Sweep',[[sg.Text('Sweep Start Voltage'), sg.Combo(voltages,size=(15,22), key='-SWP_STRT-',enable_events=True)],
-                                    [sg.Text('Sweep Stop Voltage'), sg.Combo(voltages,size=(15,22), key='-SWP_STOP-',enable_events=True)],
-                                    [sg.Text('Voltage between Steps'), sg.Combo([50,100,200],size=(15,22), key='-SWP_STEP-',enable_events=True)],
-                                    [sg.Text('No. Shots/step'), sg.Input(default_text='50',size=(15,22), key='-SWP_SHOT-',enable_events=True)]])],
-                    [sg.Tab('Ignitor',[[sg.Text('Fixed Voltage Output (V)'), sg.Input(default_text='12',size=(15,22), key='-PSU2V-',enable_events=True)],
-                                    [sg.Text('Fixed Current Limit (mA)'), sg.Input(default_text='50',size=(15,22), key='-PSU2A-',enable_events=True)],
-                                    [sg.Text('Power Supply Overide Control'),sg.Button(button_text ='Test',size=(15,1),key='-PSU2SET-')],
-                                    [sg.Text('Ignitor Timeout'), sg.Input(default_text='10',size=(15,22), key='-TIMEOUT-')],
-                                    [sg.Text('Ignition Freq (not supported)'), sg.Spin(potential_freq,size=(15,22), key='-FREQ-',enable_events=True)]])]])],
+            [sg.TabGroup([[sg.Tab('V-Fix',[[sg.Text('Voltage Selection'), sg.Combo(voltages,default_value= 1500,size=(15,22), key='-VOLTS-',enable_events=True)],
+                                        [sg.Text('Target Shot No.'), sg.Spin(potential_shots,size=(15,22), key='-SHOOT-',enable_events=True)],
+                                        [sg.Text('Fixed Voltage Output (V)'), sg.Input(default_text='12',size=(15,22), key='-PSUV-',enable_events=True)],
+                                        [sg.Text('Fixed Current Limit (mA)'), sg.Input(default_text='50',size=(15,22), key='-PSUA-',enable_events=True)],
+                                        [sg.Text('Power Supply Overide Control'),sg.Button(button_text ='Test',size=(15,1),key='-PSUSET-')]])],
+                        [sg.Tab('V-Sweep',[[sg.Text('Sweep Start Voltage'), sg.Combo(voltages,size=(15,22), key='-SWP_STRT-',enable_events=True)],
+                                        [sg.Text('Sweep Stop Voltage'), sg.Combo(voltages,size=(15,22), key='-SWP_STOP-',enable_events=True)],
+                                        [sg.Text('Voltage between Steps'), sg.Combo([50,100,200],size=(15,22), key='-SWP_STEP-',enable_events=True)],
+                                        [sg.Text('No. Shots/step'), sg.Input(default_text='50',size=(15,22), key='-SWP_SHOT-',enable_events=True)]])],
+                        [sg.Tab('Ignitor',[[sg.Text('Fixed Voltage Output (V)'), sg.Input(default_text='12',size=(15,22), key='-PSU2V-',enable_events=True)],
+                                        [sg.Text('Fixed Current Limit (mA)'), sg.Input(default_text='50',size=(15,22), key='-PSU2A-',enable_events=True)],
+                                        [sg.Text('Power Supply Overide Control'),sg.Button(button_text ='Test',size=(15,1),key='-PSU2SET-')],
+                                        [sg.Text('Ignitor Timeout'), sg.Input(default_text='10',size=(15,22), key='-TIMEOUT-')],
+                                        [sg.Text('Ignition Freq (not supported)'), sg.Spin(potential_freq,size=(15,22), key='-FREQ-',enable_events=True)]])]])],
          
          
-        [sg.Button(button_text ='Run',size=(15,1),key='-RUN-')]])
+            [sg.Button(button_text ='Run',size=(15,1),key='-RUN-')]])
 
-col2 = [[sg.Text('Last Image')],
-        [image_elem]
-    ]
+    col2 = [[sg.Text('Last Image')],
+            [image_elem]
+        ]
 
 
-col3 = sg.Frame('',[[sg.Frame('',[[sg.Text('IBIT')],[sg.StatusBar('',k='-BIT-',s=(5,2))]]),
-         sg.Frame('',[[sg.Text('Last Voltage')],[sg.StatusBar('',k='-LASTV-',s=(5,2))]]),
-         sg.Frame('',[[sg.Text('Shot No.')],[sg.StatusBar('',k='-SHOTN-',s=(5,2))]]),
-         sg.Frame('',[[sg.Text('Sensor Heath')],[sg.StatusBar('',k='-SENSORH-',s=(5,2))]]) ],
-        [sg.Canvas(size=(400,200),key='-GRAPH1-')],[sg.Canvas(size=(400,200),key='-GRAPH3-',visible=False)],
-        [sg.Canvas(size=(400,200),key='-GRAPH2-')]])
+    col3 = sg.Frame('',[[sg.Frame('',[[sg.Text('IBIT')],[sg.StatusBar('',k='-BIT-',s=(5,2))]]),
+             sg.Frame('',[[sg.Text('Last Voltage')],[sg.StatusBar('',k='-LASTV-',s=(5,2))]]),
+             sg.Frame('',[[sg.Text('Shot No.')],[sg.StatusBar('',k='-SHOTN-',s=(5,2))]]),
+             sg.Frame('',[[sg.Text('Sensor Heath')],[sg.StatusBar('',k='-SENSORH-',s=(5,2))]]) ],
+            [sg.Canvas(size=(400,200),key='-GRAPH1-')],[sg.Canvas(size=(400,200),key='-GRAPH3-',visible=False)],
+            [sg.Canvas(size=(400,200),key='-GRAPH2-')]])
         
 
-col4 = sg.Frame('',[[sg.Text('Log')],
-        [sg.StatusBar('', k='-LOG-', s=(200,1))]])
+    col4 = sg.Frame('',[[sg.Text('Log')],
+            [sg.StatusBar('', k='-LOG-', s=(200,1))]])
 
 
-# layout_frame_1 = [[sg.Frame('',port)], [sg.Frame('',col1)]]
+    # layout_frame_1 = [[sg.Frame('',port)], [sg.Frame('',col1)]]
 
-# layout_frame_2 = sg.Frame('',col2), sg.Frame('',col3)
+    # layout_frame_2 = sg.Frame('',col2), sg.Frame('',col3)
 
 
-layout = [[col1,col3],[col4]]
+    layout = [[col1,col3],[col4]]
 
-window = sg.Window('Test', layout,finalize=True)
+    window = sg.Window('Test', layout,finalize=True)
 
-fig_tool = utils.figure_tools(window)
+    fig_tool = utils.figure_tools(window)
 
 
-fig_tool.SetLED('-ARDUINO_STATUS-', 'red')
-fig_tool.SetLED('-SENS_STATUS-', 'red')
-fig_tool.SetLED('-PSU_STATUS-', 'red')
-fig_tool.SetLED('-PSU2_STATUS-', 'red')
+    fig_tool.SetLED('-ARDUINO_STATUS-', 'red')
+    fig_tool.SetLED('-SENS_STATUS-', 'red')
+    fig_tool.SetLED('-PSU_STATUS-', 'red')
+    fig_tool.SetLED('-PSU2_STATUS-', 'red')
 
-#Graph 1
-canvas_elem1 = window['-GRAPH1-']
-canvas1 = canvas_elem1.TKCanvas
+    #Graph 1
+    canvas_elem1 = window['-GRAPH1-']
+    canvas1 = canvas_elem1.TKCanvas
 
-fig1 = Figure(figsize=(10,4))
-fig_agg1 = fig_tool.draw_figure(canvas1, fig1)
-ax = fig1.add_subplot(111)
-ax.set_xlabel("X axis")
-ax.set_ylabel("Y axis")
-ax.grid()
+    fig1 = Figure(figsize=(10,4))
+    fig_agg1 = fig_tool.draw_figure(canvas1, fig1)
+    ax = fig1.add_subplot(111)
+    ax.set_xlabel("X axis")
+    ax.set_ylabel("Y axis")
+    ax.grid()
 
 
-#Graph 2
-canvas_elem2 = window['-GRAPH2-']
-canvas2 = canvas_elem2.TKCanvas
+    #Graph 2
+    canvas_elem2 = window['-GRAPH2-']
+    canvas2 = canvas_elem2.TKCanvas
 
-fig2 = Figure(figsize=(10,4))
-bx = fig2.add_subplot(111)
-bx.set_xlabel("X axis")
-bx.set_ylabel("Y axis")
-bx.grid()
-fig_agg2 = fig_tool.draw_figure(canvas2, fig2)
+    fig2 = Figure(figsize=(10,4))
+    bx = fig2.add_subplot(111)
+    bx.set_xlabel("X axis")
+    bx.set_ylabel("Y axis")
+    bx.grid()
+    fig_agg2 = fig_tool.draw_figure(canvas2, fig2)
 
 
 
-run_vlog = True
-run_dis = True
-run_log = True
-delay = 0
-i=0
-pool = ThreadPool(processes=6)
-disp_sensor = 0
+    run_vlog = True
+    run_dis = True
+    run_log = True
+    delay = 0
+    i=0
+    pool = ThreadPool(processes=6)
+    disp_sensor = 0
+    live1 = None
+    live2 = None
+    run_stopped = False
+    acq = None
 
-if __name__=='__main__':
 
     while True:
         
         
         i += 1
-        event, values = window.read()
+        event, values = window.read(timeout=50)
+        for live in (live1, live2):
+            if live is not None:
+                live.refresh()
+        for msg in bus.replies():
+            if msg.command in ('fault', 'terminal_fault'):
+                if 'run' in bus.names():
+                    bus.send('run', msg.command, **msg.args) # the run loop counts PSU faults
+                else:
+                    fig_tool.LogDisp('-LOG-', msg.args['text'])
+            elif msg.command == 'stopped' and msg.sender == 'run':
+                run_stopped = True
+            elif msg.sender.startswith('acq') and (acq is None or msg.sender != acq.name):
+                pass # left over from an earlier run's worker, which has been closed
+            elif msg.command == 'shot':
+                result = acq.result(msg)
+                if result is None:
+                    print('shot', msg.args['shot'], msg.args['error'])
+                    bit = 0
+                else:
+                    bit = result.bit
+                    shot_renderer.draw(result)
+                    print('analysis %0.1f ms, redraw %0.1f ms'%(result.analysis_time*1e3, shot_renderer.draw_time*1e3))
+                fig_tool.LogDisp('-BIT-', bit)
+                dbSync.db_write('Bit_test', 'test', bit)
+            elif msg.command in ('error', 'closed') and acq is not None and msg.sender == acq.name:
+                # the worker has died or exited, so no more shots can be taken
+                if msg.command == 'error':
+                    fig_tool.LogDisp('-LOG-', msg.args['text'])
+                else:
+                    acq.close()
+                    acq = None
+                if 'run' in bus.names():
+                    bus.send('run', 'stop', reason='acquisition worker '+msg.command)
+            elif msg.command == 'error':
+                fig_tool.LogDisp('-LOG-', msg.args['text'])
+            else:
+                print(msg)
         
         
         
@@ -340,7 +416,8 @@ if __name__=='__main__':
                         print('Testing')
                         module1 = collection.PollDis
                         event=''
-                        async_result2 = pool.apply_async(module1,(disp_sensor, ax, fig_agg1, controlQue))
+                        live1 = utils.LivePlot(fig_agg1, ax, ['ILD'], size=2000)
+                        async_result2 = pool.apply_async(module1,(disp_sensor, live1, bus.channel('ild')))
                         
                         run_dis = False
                         err = ''
@@ -348,8 +425,11 @@ if __name__=='__main__':
                         err = 'ILD Not Open'
                 else:
                     print('Stopping')
-                    controlQue.put('stop')
-                    time.sleep(0.5)
+                    bus.send('ild', 'stop')
+                    bus.remove('ild')
+                    if live1 is not None: # -RUN- may have closed it already
+                        live1.close()
+                        live1 = None
                     run_dis = True
                 fig_tool.LogDisp('-LOG-',err)
         
@@ -359,7 +439,8 @@ if __name__=='__main__':
                 try:
                     unit = control.ADC24() 
                     module2 = collection.VoltLog
-                    async_result1 = pool.apply_async(module2, (dbSync,unit, bx, fig_agg2, controlQue))
+                    live2 = utils.LivePlot(fig_agg2, bx, ['Sens 0', 'Sens 1'], size=2000)
+                    async_result1 = pool.apply_async(module2, (dbSync,unit, live2, bus.channel('vlog')))
                     err = ''
                 except:
                     err = 'ADC24 Connection Failed'
@@ -367,16 +448,23 @@ if __name__=='__main__':
                 run_vlog = False
             else:
                 print('Stopping')
-                controlQue.put('stop')
+                bus.send('vlog', 'stop')
+                bus.remove('vlog')
+                if live2 is not None:
+                    live2.close()
+                    live2 = None
                 run_vlog = True
                 
             fig_tool.LogDisp('-LOG-',err)
                 
-        if event=='-RUN-' or not stateQue.empty():
-            if not stateQue.empty():
-                stateQue.get()
+        if event=='-RUN-' or run_stopped:
+            if run_stopped:
+                run_stopped = False
                 run_log = False
 
+            if live1 is not None:
+                live1.close()
+                live1 = None
             fig_tool.delete_figure_agg(fig_agg1)
             if run_log:
                 run_log = False
@@ -396,10 +484,14 @@ if __name__=='__main__':
                 print('drawing figure')
 
                 fig_agg1 = fig_tool.draw_figure(canvas1, fig3)
+                shot_renderer = utils.ShotRenderer(fig_agg1, ax, cx)
                 runSetup(fig_agg1)
             else:
                 run_log = True
-                controlQue.put(['stop']*4)
+                for name in bus.names():
+                    if name == 'run' or name.startswith(('acq', 'psu')):
+                        bus.send(name, 'stop')
+                        bus.remove(name)
                 fig_agg1 = fig_tool.draw_figure(canvas1, fig1)
                 
             fig_tool.LogDisp('-LOG-',err)  
@@ -415,7 +507,9 @@ if __name__=='__main__':
             
         if event == "Exit" or event == sg.WIN_CLOSED:
             print('close')
-            controlQue.put(['stop']*4)
+            bus.broadcast('stop')
+            if acq is not None:
+                acq.close() # let it finish writing the stream
             try:
                 disp_sensor.close()
             except:
@@ -428,6 +522,7 @@ if __name__=='__main__':
                 board.exit()
             except:
                 pass
+            dbSync.close() # write out anything still queued
             window.Close()
             break        
 
@@ -31,6 +31,14 @@ class WrongInstrumentError(Exception):
     """
     pass
 
+class InstrumentDisconnectedError(IOError):
+    """The instrument has been disconnected, so can't be read from.
+
+    This happens after too many consecutive IO errors. Fix the problem then
+    use connect() to get it back.
+    """
+    pass
+
 class InstrumentSaysNo(Exception):
     """For some reason, the instrument did not do what the message asked.
 
@@ -220,6 +228,32 @@ class Instrument(_Freezable, metaclass=_Multiton):
                                   + "Fix the problem then use self.connect() to get it back")
                 raise e
 
+    def raw_read_bytes(self, count=None):
+        """Read binary data from the instrument: exactly count bytes, or
+        up to the termination (or end of message) if count is None.
+        Raises InstrumentDisconnectedError if disconnected."""
+        with self.lock:
+            if self._pyvisa is None:
+                raise InstrumentDisconnectedError(f"{self} is disconnected, use connect() to get it back")
+            while time.time() - self._last_io_time < self._io_holdoff:
+                time.sleep(self._io_holdoff / 5)
+            try:
+                if count is None:
+                    ans = self._pyvisa.read_raw()
+                else:
+                    ans = self._pyvisa.read_bytes(count)
+                self._last_io_time = time.time()
+                self._num_io_fails = 0
+                return ans
+            except pyvisa.VisaIOError as e:
+                if (self._max_io_fails is not None) and (self._num_io_fails < self._max_io_fails):
+                    self._num_io_fails += 1
+                else:
+                    self.disconnect()
+                    _logger.error(f"{self._num_io_fails} IO errors on {str(self)}, disconnecting. "
+                                  + "Fix the problem then use self.connect() to get it back")
+                raise e
+
     def raw_query(self, string):
         """Write string then read from the instrument"""
         # not using pyvisa.query as some instruments may override one
@@ -269,6 +303,99 @@ class ChildInstrument(_Freezable):
         return self.parent.raw_query(*args, **kwargs)
 
 
+class MultiLock():
+    """Holds the locks of several instruments at once, without deadlocking.
+
+    For composite instruments such as a CapScanner, which need exclusive
+    use of several instruments for a measurement. The locks are always
+    taken in the same global order, so two MultiLocks sharing instruments
+    can't each hold a lock the other is waiting for. Acquiring blocks
+    rather than polling; a wait longer than warn_after seconds is logged
+    with the instrument that is holding things up, and acquire gives up
+    with TimeoutError after timeout seconds (default never).
+
+    Use as a context manager, `with multilock: ...`. The instrument locks
+    are RLocks, so nesting is fine, but a thread already holding one of the
+    locks should not then use a MultiLock which includes others, as that
+    breaks the ordering.
+
+    stats holds contention statistics: acquisitions, how many had to wait,
+    total and longest wait in seconds, and the waits which hit warn_after.
+    """
+
+    def __init__(self, instruments, name='MultiLock', warn_after=5.0, timeout=None):
+        by_lock = {}
+        for instrument in instruments:
+            by_lock.setdefault(id(instrument.lock), instrument)
+        # id() is fixed for the life of the lock, so gives the global order
+        self._instruments = [by_lock[key] for key in sorted(by_lock)]
+        self.name = name
+        self.warn_after = warn_after
+        self.timeout = timeout
+        self._stats_lock = threading.Lock()
+        self.stats = dict(acquisitions=0, contended=0, total_wait=0.0, max_wait=0.0, long_waits=0)
+
+    def __str__(self):
+        return self.name + ' on ' + ', '.join(str(i) for i in self._instruments)
+
+    def acquire(self):
+        """Take all the locks, in order. Blocks until they are all held."""
+        start = time.perf_counter()
+        taken = []
+        warned = False
+        try:
+            for instrument in self._instruments:
+                while not instrument.lock.acquire(timeout=self._next_wait(start, warned)):
+                    waited = time.perf_counter() - start
+                    if self.timeout is not None and waited >= self.timeout:
+                        raise TimeoutError(f"{self.name} waited {waited:.1f}s for {instrument}")
+                    if not warned:
+                        warned = True
+                        _logger.warning(f"{self.name} has waited {waited:.1f}s for {instrument}")
+                taken.append(instrument.lock)
+        except BaseException:
+            for lock in reversed(taken):
+                lock.release()
+            raise
+        waited = time.perf_counter() - start
+        with self._stats_lock:
+            self.stats['acquisitions'] += 1
+            self.stats['total_wait'] += waited
+            self.stats['max_wait'] = max(self.stats['max_wait'], waited)
+            if waited > 1e-3:
+                self.stats['contended'] += 1
+            if warned:
+                self.stats['long_waits'] += 1
+
+    def _next_wait(self, start, warned):
+        """How long the next blocking acquire may take before we look again"""
+        deadlines = [] if self.timeout is None else [self.timeout]
+        if not warned and self.warn_after is not None:
+            deadlines.append(self.warn_after)
+        if not deadlines:
+            return -1  # block indefinitely
+        return max(min(deadlines) - (time.perf_counter() - start), 0)
+
+    def release(self):
+        """Release all the locks. Only call from the thread which acquired them."""
+        for instrument in reversed(self._instruments):
+            instrument.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def stats_summary(self):
+        s = self.stats
+        mean = s['total_wait'] / s['acquisitions'] if s['acquisitions'] else 0
+        return (f"{self.name}: {s['acquisitions']} acquisitions, {s['contended']} contended, "
+                f"mean wait {mean * 1e3:.1f}ms, max wait {s['max_wait'] * 1e3:.1f}ms, "
+                f"{s['long_waits']} over {self.warn_after}s")
+
+
 def _make_setter(command, fmt="{}"):
     """Return a setter for use with property().
 
@@ -302,6 +429,8 @@ def _make_getter(command, format):
 
     def scpi_getter(self):
         resp = self.raw_query(command.format(subaddr=self._sub_address))
+        if resp is None:
+            raise InstrumentDisconnectedError(f"{self} is disconnected, use connect() to get it back")
         parsed = parse.parse(format, resp, dict(bool=bool_parser))
         if parsed is None:
             raise IOError('Could not parse the response "{}" from the instrument'.format(resp))
@@ -6,12 +6,28 @@
 """
 Scanner based on a bridge and several multiplexers, plus helper classes.
 Normal use is to construct a CapSet for each multiplexer then a CapScanner
-using them.  Multiple CapScanners using the same bridge are supported but
-the necessary locking is not well tested.
+using them.  Multiple CapScanners using the same bridge are supported;
+the instruments are locked together with a MultiLock so they can't
+deadlock.
 """
 import time
-import random
-from instruments import _logger
+import weakref
+import threading
+import numpy as np
+from instruments import _logger, MultiLock
+
+# Last output written to each multiplexer, shared by every CapScanner using it.
+# Anything that sets a multiplexer's output directly should call forget_routes.
+_routes = weakref.WeakKeyDictionary()
+
+
+def forget_routes(mplex=None):
+    """Forget the tracked route of one multiplexer (default all), so the next
+    select writes it again."""
+    if mplex is None:
+        _routes.clear()
+    else:
+        _routes.pop(mplex, None)
 
 
 class CapSet:
@@ -83,87 +99,216 @@ class CapScanner:
         self.capsets = capsets
         self._bridge_wait_time = 0  # For small capacitances, first measurement after abort is fine.
         self._relay_wait_time = 0.01  # probably conservative, in testing even 0 was fine.
-        self._all_locks = [bridge.lock] + [capset.mplex.lock for capset in capsets]
-        self._have_locks = [False] * len(self._all_locks)
+        self.locks = MultiLock([bridge] + [capset.mplex for capset in capsets], name='CapScanner')
         self.labels = sum((capset.caps for capset in capsets), ())
+        # for each channel, the capset index and multiplexer output it needs
+        self._channel_map = [(ix, capset.mp_position(n + 1))
+                             for ix, capset in enumerate(capsets) for n in range(len(capset))]
 
     def __len__(self):
         return sum([len(i) for i in self.capsets])
 
-    def _aquire_locks(self):
-        while not all(self._have_locks):
-            for ix, lock in enumerate(self._all_locks):
-                self._have_locks[ix] = lock.acquire(timeout=0.1)
-                if not self._have_locks[ix]:
-                    break
-            if not all(self._have_locks):
-                self._release_locks
-                wait = 0.5 + random.random()
-                _logger.warning(
-                    f"CapScanner could not lock all instruments. Trying again in {wait:.2f}s")
-                time.sleep(wait)
-
-    def _release_locks(self):
-        for ix, lock in enumerate(self._all_locks):
-            if self._have_locks[ix]:
-                lock.release()
-                self._have_locks[ix] = False
-
-    def __del__(self):
-        try:
-            self._release_locks()
-        except Exception:
-            pass
-
     def select(self, channel):
-        """Set a single channel through the multiplexers to the bridge"""
+        """Set a single channel through the multiplexers to the bridge.
+
+        Only multiplexers whose output needs to change are written to, and
+        the relay wait and bridge restart are skipped if nothing moved.
+        Returns the number of multiplexers written."""
         if channel > len(self):
             raise RuntimeError(f"This CapScanner only has {len(self)} channels but channel {channel} was requested")
-        count = 0
-        for capset in self.capsets:
-            low = count + 1
-            high = count + len(capset)
-            count = high
-            if low <= channel <= high:
-                capset.mplex.output = capset.mp_position(channel - low + 1)
-            else:
-                capset.mplex.output = 0
-        time.sleep(self._relay_wait_time)
-        self.bridge.abort_meas()  # restart measurment
+        target_ix, target_pos = self._channel_map[channel - 1]
+        moved = 0
+        for ix, capset in enumerate(self.capsets):
+            position = target_pos if ix == target_ix else 0
+            if _routes.get(capset.mplex) != position:
+                _routes.pop(capset.mplex, None)  # unknown until the write succeeds
+                capset.mplex.output = position
+                _routes[capset.mplex] = position
+                moved += 1
+        if moved:
+            time.sleep(self._relay_wait_time)
+            self.bridge.abort_meas()  # restart measurment
+        return moved
+
+    def sweep_order(self):
+        """All channels, ordered so that consecutive channels share a
+        multiplexer, starting with whatever is routed to the bridge now."""
+        current = [_routes.get(capset.mplex) for capset in self.capsets]
+        groups = {}
+        for channel, (ix, position) in enumerate(self._channel_map, 1):
+            groups.setdefault(ix, []).append(channel)
+        # the multiplexer which is switched on goes first, starting at its channel
+        order = sorted(groups, key=lambda ix: not current[ix])
+        channels = []
+        for ix in order:
+            group = groups[ix]
+            group.sort(key=lambda ch: self._channel_map[ch - 1][1] != current[ix])
+            channels += group
+        return channels
 
     def measure(self, channel):
         """Measure a capactior. Configures multiplexers and makes measurement"""
-        try:
-            self._aquire_locks()
+        with self.locks:
             self.select(channel)
             time.sleep(self._bridge_wait_time)
             return self.bridge.meas_all
-        finally:
-            self._release_locks()
 
     def measure_all(self):
-        """Measures all the attached capacitors and returns a list of values"""
-        values = []
-        for channel in range(len(self)):
-            values = values + self.measure(channel + 1)
-        return values
+        """Measures all the attached capacitors and returns a list of values,
+        in channel order. The channels are visited in sweep_order."""
+        results = {}
+        with self.locks:
+            for channel in self.sweep_order():
+                self.select(channel)
+                time.sleep(self._bridge_wait_time)
+                results[channel] = self.bridge.meas_all
+        return sum((list(results[channel]) for channel in range(1, len(self) + 1)), [])
 
 
 class AutoCapScanner(CapScanner):
-    # TODO: write this if we need it.
-    # Auto version needs it's own thread. Main advantage is that it is IO bound and
-    # won't have to wait for other IO. Maybe a multi-thread Recorder would be better?
-    # It keeps changing round the caps, measuring them as fast as possible.
-
-    # It has a get immediate option to get the most recent buffered data
-    # it has a blocking option which makes all new measurements
-    # it could also have an option which guaranttees new data, and waits if necessary
-    # though it won't be able to identify different consumers so "new" is relative
-    # One of the latter two would be best for rate limiting a recorder
-    # What if I have different consumers with different channels?
-    # Would I support different rates in that case?
-    # Does this need to monopolise the bridge (multition? keep hold of lock?)
-    pass
+    def __init__(self, bridge, capsets):
+        """
+        CapScanner which measures round all its channels continuously on its
+        own thread and buffers the results.
+
+        Parameters are as for CapScanner. Scanning starts immediately and
+        runs until stop() is called. The locks on the bridge and multiplexers
+        are held for each sweep and released for _yield_time s between
+        sweeps, so other scanners sharing the bridge can get a turn.
+
+        There are three ways to read, each taking an optional list of
+        channels (numbered from 1 as for select, default all of them) and
+        returning values in the same flat format as measure_all:
+
+        get_latest : the most recent value of each channel, without waiting.
+            NaN for channels not yet measured.
+        get_fresh : waits until every channel has been measured since the
+            call. Good for rate limiting a recorder.
+        sweep : waits for a sweep that started after the call to finish, so
+            all the values come from one pass round the caps.
+
+        Each takes timestamps=True to also return the time.time() at which
+        each channel's measurement started, as (times, values).
+
+        Several consumers can share one scanner, each with its own channels,
+        using view(channels), which returns an object that works with
+        measurement.quantity_from_scanner.
+        """
+        super().__init__(bridge, capsets)
+        self._values_per_channel = 3
+        self._yield_time = 0.01  # lock releases aren't fair, so give waiting scanners a chance
+        self._cond = threading.Condition()
+        self._times = [0.0] * len(self)
+        self._values = [[np.nan] * self._values_per_channel for _ in range(len(self))]
+        self._sweep_values = (list(self._times), [list(v) for v in self._values])
+        self._sweeps_started = 0
+        self._sweeps_done = 0
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='AutoCapScanner', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        if len(self) == 0:  # nothing to sweep, so just wait to be stopped
+            with self._cond:
+                self._cond.wait_for(lambda: self._stopping)
+            return
+        while not self._stopping:
+            try:
+                with self.locks:
+                    self._sweep()
+                time.sleep(self._yield_time)
+            except Exception:
+                _logger.error("AutoCapScanner sweep failed, trying again", exc_info=True)
+                time.sleep(1)
+
+    def _sweep(self):
+        with self._cond:
+            self._sweeps_started += 1
+        for channel in self.sweep_order():
+            if self._stopping:
+                return
+            started = time.time()  # so get_fresh never takes a reading begun before it was called
+            self.select(channel)
+            time.sleep(self._bridge_wait_time)
+            values = self.bridge.meas_all
+            with self._cond:
+                self._times[channel - 1] = started
+                self._values[channel - 1] = values
+                self._values_per_channel = len(values)
+                self._cond.notify_all()
+        with self._cond:
+            self._sweeps_done += 1
+            self._sweep_values = (list(self._times), list(self._values))
+            self._cond.notify_all()
+
+    def stop(self):
+        """Stop scanning. Waits for the current measurement to finish."""
+        self._stopping = True
+        with self._cond:
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _pick(self, times, values, channels, timestamps):
+        if channels is None:
+            channels = range(1, len(self) + 1)
+        picked = sum((list(values[ch - 1]) for ch in channels), [])
+        if timestamps:
+            return [times[ch - 1] for ch in channels], picked
+        return picked
+
+    def _wait(self, predicate, timeout):
+        """Wait on self._cond (held) for predicate, or stop() being called"""
+        if not self._cond.wait_for(lambda: predicate() or self._stopping, timeout):
+            raise TimeoutError("AutoCapScanner did not measure in time")
+        if not predicate():
+            raise RuntimeError("AutoCapScanner was stopped")
+
+    def get_latest(self, channels=None, timestamps=False):
+        """Most recent values, without waiting"""
+        with self._cond:
+            return self._pick(self._times, self._values, channels, timestamps)
+
+    def get_fresh(self, channels=None, timestamps=False, timeout=None):
+        """Values all measured after this call, i.e. measurements which started
+        after it. Raises TimeoutError after timeout s."""
+        start = time.time()
+        chans = range(1, len(self) + 1) if channels is None else channels
+        with self._cond:
+            self._wait(lambda: all(self._times[ch - 1] > start for ch in chans), timeout)
+            return self._pick(self._times, self._values, channels, timestamps)
+
+    def sweep(self, channels=None, timestamps=False, timeout=None):
+        """Values from one whole sweep that started after this call."""
+        with self._cond:
+            target = self._sweeps_started + 1
+            self._wait(lambda: self._sweeps_done >= target, timeout)
+            return self._pick(*self._sweep_values, channels, timestamps)
+
+    def measure_all(self):
+        """Same as get_fresh(), so several readers share the sweeps"""
+        return self.get_fresh()
+
+    def view(self, channels, mode='fresh'):
+        """A consumer reading only `channels`, with mode 'fresh', 'latest' or 'sweep'"""
+        return _ScannerView(self, channels, mode)
+
+
+class _ScannerView:
+    """Part of an AutoCapScanner, with the len, labels and measure_all that
+    quantity_from_scanner needs."""
+
+    def __init__(self, scanner, channels, mode='fresh'):
+        self.scanner = scanner
+        self.channels = list(channels)
+        self.labels = tuple(scanner.labels[ch - 1] for ch in self.channels)
+        self._read = {'fresh': scanner.get_fresh, 'latest': scanner.get_latest,
+                      'sweep': scanner.sweep}[mode]
+
+    def __len__(self):
+        return len(self.channels)
+
+    def measure_all(self):
+        return self._read(self.channels)
 
 
 if __name__ == "__main__":
@@ -173,19 +318,28 @@ if __name__ == "__main__":
     print("Testing CapScanner Module")
 
     class DummyInstr:
-        def __init__(self, name):
+        """Stands in for both bridge and multiplexer, counting relay writes"""
+        def __init__(self, name, verbose=True):
             self.visa_name = name
             self.lock = RLock()
+            self.writes = 0
+            self.verbose = verbose
 
         def set_output(self, output):
-            print(f"mplex at {self.visa_name} set to {output}")
+            self.writes += 1
+            if self.verbose:
+                print(f"mplex at {self.visa_name} set to {output}")
 
         def meas(self):
-            print(f"bridge at {self.visa_name} made measurement")
-            return [1, 2]
+            if self.verbose:
+                print(f"bridge at {self.visa_name} made measurement")
+            return [1, 2, 3]
+
+        def abort_meas(self):
+            pass
 
         output = property(fget=None, fset=set_output)
-        meas = property(fget=meas, fset=None)
+        meas_all = property(fget=meas, fset=None)
 
     m1 = DummyInstr('no1')
     m2 = DummyInstr('no2')
@@ -203,3 +357,34 @@ if __name__ == "__main__":
     scan = CapScanner(DummyInstr('bridge'), (c1, c2, c3, c4))
     assert(len(scan) == len(c1) + len(c2) + len(c3) + len(c4))
     quantity_from_scanner(scan)
+
+    print("\nBenchmark: 20 sweeps of 8 caps on 4 multiplexers")
+    for instr in (m1, m2, m3, m4, scan.bridge):
+        instr.verbose = False
+    mplexes = (m1, m2, m3, m4)
+
+    def bench(track_routes):
+        forget_routes()
+        for m in mplexes:
+            m.writes = 0
+        start = time.perf_counter()
+        for _ in range(20):
+            for channel in range(1, len(scan) + 1):
+                if not track_routes:
+                    forget_routes()  # every write is sent, as before route tracking
+                scan.select(channel)
+        per_sweep = (time.perf_counter() - start) / 20
+        return sum(m.writes for m in mplexes) / 20, per_sweep
+
+    writes, per_sweep = bench(False)
+    print(f"  write every multiplexer:  {writes:5.1f} relay writes, {per_sweep*1e3:6.1f} ms per sweep")
+    writes, per_sweep = bench(True)
+    print(f"  changed routes only:      {writes:5.1f} relay writes, {per_sweep*1e3:6.1f} ms per sweep")
+    for m in mplexes:
+        m.writes = 0
+    start = time.perf_counter()
+    for _ in range(20):
+        scan.measure_all()
+    per_sweep = (time.perf_counter() - start) / 20
+    print(f"  measure_all (sweep_order): {sum(m.writes for m in mplexes) / 20:4.1f} relay writes, "
+          f"{per_sweep*1e3:6.1f} ms per sweep")
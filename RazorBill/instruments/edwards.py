@@ -13,9 +13,9 @@ Module for reading from Edwards vacuum guages
 
 from . import Instrument, WrongInstrumentError
 from measurement import ThreadWithExcLog
+from measurement.transforms import Table
 import parse
 import numpy as np
-from scipy.interpolate import interp1d
 import time
 
 class AbnormalResponse(Exception):
@@ -243,6 +243,11 @@ class nAIM_P():
     it contains a method for converting voltage to pressure. The voltage value
     must first be obtained from another instrument with an analog input
     (probaby the CTC100)
+
+    The conversion is also available as a transform, to log pressure
+    directly: ``Quantity('Pressure', (ctc, 'AIO1'), 'mbar',
+    transforms=[nAIM_P.transform])``. Outside 2-10 V, or for NaN, the
+    gauge is off or at atmosphere and 1000 mbar is returned.
     """
 
     def __init__(self, quantity):
@@ -289,14 +294,9 @@ class nAIM_P():
                          [9.9, 3.6e-3],
                          [10, 1e-2   ]])
 
-    #this is a callable!
-    interpolator = interp1d(caltable[:,0], caltable[:,1], kind='cubic')
+    # vectorised, works on a single voltage or an array of them
+    transform = Table(caltable[:,0], caltable[:,1], kind='cubic', fill=1000)
 
     @property
     def pressure(self):
-        voltage = self.quantity.value
-        if (-0.1 < voltage < 2): return 1000
-        if (10 < voltage): return 1000
-        if (np.isnan(voltage)): return 1000
-        pressure = float(self.interpolator(voltage))
-        return pressure
+        return float(self.transform(self.quantity.value))
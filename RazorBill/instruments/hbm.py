@@ -4,8 +4,9 @@ Module for interfacing with products from HBM (who have rebranded as HBK)
 It includes the load cell controller ClipX used for the load test rig
 """
 
-from . import Instrument, WrongInstrumentError, BadCommandError, _make_getter
+from . import Instrument, WrongInstrumentError, BadCommandError, _make_getter, _logger
 import time
+import threading
 from measurement import ThreadWithExcLog
 
 
@@ -31,10 +32,12 @@ class ClipX(Instrument):
     used to protect the load cell form overloading.
 
     It is possible to regularily read a FIFO buffer, so that no data is
-    missing. It is not implemnted yet.
+    missing. It is not implemnted yet: the SDO objects for it have not been
+    checked on an instrument.
 
-    Connections are automatically closed after 30 sec inactivity, so a thread
-    is used to keep it open by taking and dropping measurements.
+    Connections are automatically closed after 30 sec inactivity, so a
+    background thread keeps it open by taking and dropping a measurement if
+    nothing else has talked to the ClipX for a while. close() stops the thread.
 
     Construction
     ------------
@@ -55,6 +58,8 @@ class ClipX(Instrument):
     tare_reset() : cancel the tare function
         .
 
+    close() : stop the background thread and disconnect
+
     Dynamic Properties
     ----------
     force_filtered : Force, in Newtons, after tare and filtering
@@ -73,20 +78,40 @@ class ClipX(Instrument):
     """
 
     _idnstring = "153"
+    _keepalive_period = 10  # s of silence before polling, well inside the 30 s timeout
 
     def _setup(self):
-        """ Configure ethernet, and start keep-alive thread. The device needs
+        """ Configure ethernet, and start the background thread. The device needs
         real messages to stay on line: normal ethernet keep-alive packets
         are not enough"""
         self._pyvisa.read_termination = '\n'
         self._pyvisa.write_termination = '\n'
-        def poll_device():
-            while(True):
-                self.force_gross
-                time.sleep(10)
-        clipx_keepalive_thread = ThreadWithExcLog(target=poll_device,
-                                                  name="clipx_keepalive")
-        clipx_keepalive_thread.start()
+        thread = getattr(self, '_background_thread', None)
+        if thread is None or not thread.is_alive():  # not already running from a previous connect
+            self._stop = threading.Event()
+            self._background_thread = ThreadWithExcLog(target=self._background,
+                                                       name="clipx_background", daemon=True)
+            self._background_thread.start()
+
+    def _background(self):
+        while not self._stop.wait(1):
+            if self._pyvisa is None:
+                continue
+            if time.time() - self._last_io_time > self._keepalive_period:
+                # if someone else has the lock they are talking to it, which is just as good
+                if self.lock.acquire(blocking=False):
+                    try:
+                        self.force_gross
+                    except Exception:
+                        _logger.warning("ClipX keep-alive poll failed", exc_info=True)
+                    finally:
+                        self.lock.release()
+
+    def close(self):
+        """Stop the background thread, then disconnect"""
+        self._stop.set()
+        self._background_thread.join()
+        self.disconnect()
 
     def write(self, message):
         resp = self.raw_query(message)
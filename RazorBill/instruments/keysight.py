@@ -11,9 +11,20 @@ from . import ScpiInstrument, _scpi_property
 
 
 class E4980A(ScpiInstrument):
-    """Keysight E4980[A|AL] LCR meter"""
+    """Keysight E4980[A|AL] LCR meter
+
+    By default the meter measures continuously on its internal trigger and
+    meas_all reads the latest result. After bus_trigger_mode() it only
+    measures when asked, and meas_all triggers one measurement and reads
+    cap, loss and excitation voltage back in a single query.  list_sweep
+    runs a frequency or voltage list sweep from one trigger and fetches
+    all the points in one transfer.
+    """
 
     _idnstring = ["Keysight Technologies,E4980", "Agilent Technologies,E4980"]
+    _bus_triggered = False
+    _page = None
+    _max_list_points = 201
 
     meas = _scpi_property('FETCH', '{:g},{:g},+0', doc="cap and loss",
                           can_set=False)
@@ -24,14 +35,79 @@ class E4980A(ScpiInstrument):
     mode = _scpi_property('FUNC:IMP:TYPE', '{}', doc='one of CPD,CPQ,CPG,'
                           'CPRP,CSD,CSQ,CSRS,LPD,LPQ,LPG,LPRP,LPRD,LSD,LSQ,'
                           'LSRS,LSRD,RX,ZTD,ZTR,GB,YTD,YTR,VDID')
+    trigger_source = _scpi_property('TRIG:SOUR', '{}', doc="one of INT, EXT, BUS, HOLD")
 
     @property
     def meas_all(self):
         """Include exc. voltage, in case that is useful for debugging down the line"""
+        if self._bus_triggered:
+            return self.measure_triggered()
         meas = self.meas
         volt_act = self.ex_volt_act
         return meas + [volt_act]
 
+    def _show_page(self, page):
+        """The meter runs list sweeps from the LIST page and single points from MEAS"""
+        if self._page != page:
+            self.raw_write("DISP:PAGE " + page)
+            self._page = page
+
+    def bus_trigger_mode(self, bus=True):
+        """Measure only when triggered (bus=True) or continuously (bus=False)"""
+        with self.lock:
+            self.raw_write("ABOR")
+            self.raw_write("INIT:CONT ON")
+            self.trigger_source = "BUS" if bus else "INT"
+            self._bus_triggered = bus
+
+    def measure_triggered(self):
+        """Trigger one measurement, returns [cap, loss, exc. voltage].
+
+        Needs bus_trigger_mode. *TRG returns the measurement once it is
+        complete, so it and the excitation voltage come back in one reply.
+        """
+        with self.lock:
+            self._show_page("MEAS")
+            resp = self.raw_query("*TRG;:FETC:SMON:VAC?")
+        values = [float(v) for v in resp.replace(';', ',').split(',')]
+        if len(values) != 4:
+            raise IOError('Could not parse the response "{}" from the instrument'.format(resp))
+        if values[2] != 0:
+            raise IOError("Measurement status {:d} (overload or no contact)".format(int(values[2])))
+        return values[:2] + values[3:]
+
+    def list_sweep(self, freqs=None, volts=None):
+        """Measure at each of a list of frequencies or excitation voltages.
+
+        Give one of freqs (Hz) or volts (V), up to 201 points. The whole
+        sweep runs from one bus trigger, waits with *OPC? and the results
+        are fetched in one transfer. Returns a list of [cap, loss] per point.
+        Leaves the meter in bus trigger mode.
+        """
+        if (freqs is None) == (volts is None):
+            raise ValueError("Give either freqs or volts")
+        command, points = ("LIST:FREQ ", freqs) if volts is None else ("LIST:VOLT ", volts)
+        if not 0 < len(points) <= self._max_list_points:
+            raise ValueError(f"List sweeps take 1 to {self._max_list_points} points")
+        with self.lock:
+            if not self._bus_triggered:
+                self.bus_trigger_mode()
+            self._show_page("LIST")
+            self.raw_write("LIST:MODE SEQ")
+            self.raw_write(command + ",".join("{:g}".format(p) for p in points))
+            timeout = self._pyvisa.timeout
+            try:
+                self._pyvisa.timeout = timeout + 1000 * len(points)
+                self.raw_query("TRIG:IMM;*OPC?")
+            finally:
+                self._pyvisa.timeout = timeout
+            resp = self.raw_query("FETC?")
+        # each point is cap, loss, status, comparator result
+        values = resp.split(',')
+        if len(values) != 4 * len(points):
+            raise IOError('Expected {} points, got "{}"'.format(len(points), resp))
+        return [[float(values[i]), float(values[i + 1])] for i in range(0, len(values), 4)]
+
     def recall_A(self):
         self.raw_write("MMEM:LOAD:STAT:REG 0")
 
@@ -47,9 +123,13 @@ class E4980A(ScpiInstrument):
     def abort_meas(self):
         """Restarts measurement.
 
-        Assuming the bridge is in continuous measurement mode (internal trigger) this will
-        abort the current measurement and restart. Useful after e.g. a multiplexer change.
+        In continuous measurement mode (internal trigger) this will abort the
+        current measurement and restart. Useful after e.g. a multiplexer change.
+        In bus trigger mode every reading is a new measurement anyway, so
+        there is nothing to do.
         """
+        if self._bus_triggered:
+            return
         self.raw_write("ABOR")
         self.raw_write("TRIG:SOUR INT")
 
@@ -15,6 +15,13 @@ import pyvisa
 from . import ScpiInstrument, ChildInstrument, _scpi_property, _make_getter, _make_setter
 
 
+def _query_floats(instrument, queries):
+    """Send several queries as one ';' separated command and parse the
+    ';' separated reply, so they cost one round trip."""
+    resp = instrument.raw_query(';'.join(queries))
+    return [float(v) for v in resp.split(';')]
+
+
 class _Input(ChildInstrument):
     """
     Class for input channels in a Lakeshore instrument, providing properties for
@@ -38,9 +45,50 @@ class _Loop(ChildInstrument):
     ramp_in_progress = property(_make_getter('RAMPST? {subaddr:},', '{:bool}'))
 
 
+class _ControllerBulkRead():
+    """
+    Bulk reads for controllers with a heater, for the 331 and 340. Each
+    property is one compound query over the instrument's `inputs` and
+    `loops` dicts, so it follows whichever inputs are fitted.
+    """
+    def _control_queries(self):
+        return ['HTR?', 'RANGE?'] + ['SETP? {}'.format(n) for n in self.loops]
+
+    @property
+    def all_kelvin(self):
+        return _query_floats(self, ['KRDG? ' + n for n in self.inputs])
+
+    @property
+    def all_sensor(self):
+        return _query_floats(self, ['SRDG? ' + n for n in self.inputs])
+
+    @property
+    def control_status(self):
+        """[heater_power, heater_range, loop 1 setpoint, loop 2 setpoint]"""
+        return _query_floats(self, self._control_queries())
+
+    @property
+    def all_vals(self):
+        """all_kelvin followed by control_status, in one query"""
+        return _query_floats(self, ['KRDG? ' + n for n in self.inputs] + self._control_queries())
+
+    @property
+    def all_val_names(self):
+        return (['T' + n for n in self.inputs] + ['Heater', 'Heater range']
+                + ['Setpoint {}'.format(n) for n in self.loops])
+
+    @property
+    def all_val_units(self):
+        return ['K'] * len(self.inputs) + ['%', '-'] + ['K'] * len(self.loops)
+
+
 class Lakeshore218(ScpiInstrument):
     """
     Class for a Lakeshore model 218 temperature monitor
+
+    all_kelvin and all_sensor read all eight inputs with one query.
+    all_vals, all_val_names and all_val_units are the same as all_kelvin
+    with names and units, for measurement.quantity_from_lakeshore
     """
     def _setup(self):
         """ Configures serial and creates inputs
@@ -63,10 +111,32 @@ class Lakeshore218(ScpiInstrument):
         # FIXME: Replace NOVRAM in the 218
         pass
 
+    @property
+    def all_kelvin(self):
+        return [float(v) for v in self.raw_query('KRDG? 0').split(',')]
+
+    @property
+    def all_sensor(self):
+        return [float(v) for v in self.raw_query('SRDG? 0').split(',')]
+
+    all_vals = all_kelvin
+
+    @property
+    def all_val_names(self):
+        return ['T' + str(n) for n in self.inputs]
+
+    @property
+    def all_val_units(self):
+        return ['K'] * len(self.inputs)
 
-class Lakeshore340(ScpiInstrument):
+
+class Lakeshore340(_ControllerBulkRead, ScpiInstrument):
     """
     Class for a Lakeshore model 340 temperature controller
+
+    all_kelvin, all_sensor and control_status (heater and setpoints) each
+    take one compound query. all_vals is all of those in one query, with
+    all_val_names and all_val_units for measurement.quantity_from_lakeshore
     """
     def __init__(self, visa_name, extra_inputs=None):
         """ Connects to the instrument and checks that it is the right one.
@@ -77,13 +147,15 @@ class Lakeshore340(ScpiInstrument):
         # set up if the instrument has the optional extra inputs
         # FIXME: Use weakrefs to clean up circular refs on deletion
         super().__init__(visa_name)
+        self._is_frozen = False  # inputs is added after Instrument.__init__ froze the object
         self.inputs = {'A':_Input(self, 'A'), 'B':_Input(self, 'B')}
         if extra_inputs:
             if extra_inputs == "3462":
                 self.inputs['C'] = _Input(self, 'C')
-                self.inputs['D'] = _Input(self, 'C')
+                self.inputs['D'] = _Input(self, 'D')
             else:
                 raise NotImplementedError("Extra input card {} not yet implemented".format(extra_inputs))
+        self._is_frozen = True
 
     def _setup(self):
         """ Configure serial interface """
@@ -98,18 +170,21 @@ class Lakeshore340(ScpiInstrument):
     heater_range = _scpi_property('RANGE', '{:d}')
 
 
-class Lakeshore331(ScpiInstrument):
+class Lakeshore331(_ControllerBulkRead, ScpiInstrument):
     """
     Class for a Lakeshore model 331 temperature controller
+
+    Has the same bulk read properties as the Lakeshore340
     """
     def _setup(self):
         """ Configure serial interface """
         self._pyvisa.parity = pyvisa.constants.Parity.odd
         self._pyvisa.data_bits = 7
+        self.inputs = {'A':_Input(self, 'A'), 'B':_Input(self, 'B')}
         self.loops = {1:_Loop(self, 1), 2:_Loop(self, 2)}
         
     _idnstring = "LSCI,MODEL331"
     _io_holdoff = 50/1000 # wait 50ms between reads/writes
 
     heater_power = _scpi_property('HTR?', '{:g}', can_set=False)
-    heater_range = _scpi_property('RANGE', '{:d}')
\ No newline at end of file
+    heater_range = _scpi_property('RANGE', '{:d}')
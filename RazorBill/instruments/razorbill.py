@@ -15,31 +15,122 @@ import time
 class _RP100_Channel(ChildInstrument):
     """
     An output subsystem on an RP100 power supply
+
+    The channel remembers the target voltage and slew rate it last set, so
+    it can predict when a ramp will finish. wait_for sleeps until just
+    before then and confirms with a single query, rather than polling the
+    supply all through a long ramp. If the output is changed from the front
+    panel or by raw_write, call forget_ramp. If the output hasn't reached
+    the target a few seconds after it should have, wait_for raises
+    TimeoutError rather than waiting forever.
     """
     enable = _scpi_property('OUTP{subaddr:}', '{:bool}', doc="Output relay status")
 
-    voltage_set = _scpi_property('SOUR{subaddr:}:VOLT', '{:g}', doc="Target voltage")
-    slew_rate = _scpi_property('SOUR{subaddr:}:VOLT:SLEW', '{:g}', doc="Slew rate")
+    _voltage_set = _scpi_property('SOUR{subaddr:}:VOLT', '{:g}', doc="Target voltage")
+    _slew_rate = _scpi_property('SOUR{subaddr:}:VOLT:SLEW', '{:g}', doc="Slew rate")
     voltage_now = _scpi_property('SOUR{subaddr:}:VOLT:NOW', '{:g}', doc="Voltage right now")
     meas_voltage = _scpi_property('MEAS{subaddr:}:VOLT', '{:g}', can_set=False, doc="Measured load voltage")
     meas_current = _scpi_property('MEAS{subaddr:}:CURR', '{:g}', can_set=False, doc="Measured load current")
 
+    tolerance = 1e-3  # V, how close voltage_now must be to the target to be done
+    _wake_early = 0.1  # s before the predicted end of a ramp to start checking
+    _poll_min = 0.02  # s, shortest and longest sleep between checks near the end
+    _poll_max = 1
+    _timeout_margin = 5  # s after the predicted end of a ramp before giving up
+    _target = None  # last known target voltage and slew rate, None if unknown
+    _slew = None
+    _ramp_end = 0  # time.monotonic() the ramp is predicted to finish
+
+    @property
+    def voltage_set(self):
+        """Target voltage"""
+        self._target = self._voltage_set
+        return self._target
+
+    @voltage_set.setter
+    def voltage_set(self, value):
+        with self.parent.lock:
+            if self._target is not None and time.monotonic() >= self._ramp_end:
+                start = self._target  # last ramp finished, so no need to ask
+            else:
+                start = self.voltage_now
+            self._voltage_set = value
+            self.voltage_set  # read back what it accepted, it may clamp or refuse the value
+            self._ramp_end = time.monotonic() + self._ramp_time(self._target - start)
+
+    @property
+    def slew_rate(self):
+        """Slew rate"""
+        self._slew = self._slew_rate
+        return self._slew
+
+    @slew_rate.setter
+    def slew_rate(self, value):
+        self._slew_rate = value
+        self._slew = float(value)
+
+    def _known_slew(self):
+        return self._slew if self._slew is not None else self.slew_rate
+
+    def _ramp_time(self, delta):
+        slew = self._known_slew()
+        return abs(delta) / slew if slew > 0 else 0
+
+    def forget_ramp(self):
+        """Drop the remembered target and slew rate, they will be read again"""
+        self._target = None
+        self._slew = None
+        self._ramp_end = 0
+
+    def _time_left(self):
+        """Predicted seconds until the ramp is nearly done, without any IO"""
+        return max(self._ramp_end - time.monotonic() - self._wake_early, 0)
+
+    def _check(self):
+        """One query. Returns 0 if done, otherwise an estimate of the seconds left"""
+        if self._target is None:
+            self.voltage_set
+        left = abs(self.voltage_now - self._target)
+        if left <= self.tolerance:
+            return 0
+        return max(self._ramp_time(left), self._poll_min)
+
     def wait_for(self):
-        while not self.is_done:
-             time.sleep(0.05)
+        _wait_for_channels([self])
 
     def safe_disable(self):
         """Ramp the voltage to zero and disable. Kinder to piezos than enable=False."""
-        old_slew = self.slew_rate
-        self.slew_rate = 50
+        old_slew = self._known_slew()
+        if old_slew != 50:
+            self.slew_rate = 50
         self.voltage_set = 0
         self.wait_for()
         self.enable = False
-        self.slew_rate = old_slew
+        if old_slew != 50:
+            self.slew_rate = old_slew
 
     @property
     def is_done(self):
-        return self.voltage_now == self.voltage_set
+        return self._check() == 0
+
+
+def _wait_for_channels(channels):
+    """Wait for several RP100 channels at once: sleep until the last ramp is
+    predicted to be nearly finished, then check them all until done."""
+    pending = list(channels)
+    time.sleep(max(channel._time_left() for channel in pending))
+    deadline = None
+    while pending:
+        left = [channel._check() for channel in pending]
+        if deadline is None:  # the first check also covers ramps not started by us
+            deadline = max([time.monotonic() + max(left)]
+                           + [channel._ramp_end for channel in pending]) + pending[0]._timeout_margin
+        pending = [channel for channel, t in zip(pending, left) if t]
+        if pending:
+            if time.monotonic() > deadline:
+                raise TimeoutError("RP100 output did not reach its target on "
+                                   + ", ".join(str(channel) for channel in pending))
+            time.sleep(min(max(left), pending[0]._poll_max))
 
 
 class RP100(ScpiInstrument):
@@ -55,9 +146,8 @@ class RP100(ScpiInstrument):
 
 
     def wait_for(self):
-        """Call wait_for on each channel."""
-        self.channels[1].wait_for()
-        self.channels[2].wait_for()
+        """Wait for both channels to finish ramping, checking them together."""
+        _wait_for_channels(self.channels.values())
 
     @property
     def is_done(self):
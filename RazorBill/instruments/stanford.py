@@ -10,12 +10,111 @@ Module for interfacing with equiptment from Stanford Reseach systems
 """
 
 from . import Instrument, ScpiInstrument, ChildInstrument, \
-                _make_setter, _make_getter, _scpi_property
+                _make_setter, _make_getter, _scpi_property, InstrumentDisconnectedError
 import bisect
+import time
 import numpy as np
 
 
-class StanfordSR830(ScpiInstrument):
+class _SR830Acquisition():
+    """SNAP? snapshots and the data buffer of the SR830. Shared by the
+    StanfordSR830 classes in this module and in stanford_sr830."""
+
+    meas_xy = property(lambda self: self.snap('x', 'y'))
+    meas_rt = property(lambda self: self.snap('r', 't'))
+
+    _snap_params = {'x': 1, 'y': 2, 'r': 3, 't': 4, 'aux1': 5, 'aux2': 6, 'aux3': 7,
+                    'aux4': 8, 'freq': 9, 'ch1': 10, 'ch2': 11}
+
+    def snap(self, *params):
+        """Read 2 to 6 values that the instrument samples at the same instant.
+
+        params are names from 'x', 'y', 'r', 't', 'aux1'-'aux4', 'freq',
+        'ch1', 'ch2' (the displays) or the SNAP? numbers 1-11.
+        e.g. x, y, f = lia.snap('x', 'y', 'freq')"""
+        if not 2 <= len(params) <= 6:
+            raise ValueError('SNAP? takes 2 to 6 parameters')
+        codes = [self._snap_params[p.lower()] if isinstance(p, str) else int(p) for p in params]
+        resp = self.raw_query('SNAP? ' + ','.join(str(c) for c in codes))
+        return tuple(float(v) for v in resp.split(','))
+
+    # Data buffer. The buffer stores the CH1 and CH2 displays, up to 16383
+    # points each. FAST mode streaming is not supported, it only works over
+    # GPIB and needs the controller to keep up with up to 512 points per second.
+    _sample_rates = (62.5e-3, 125e-3, 250e-3, 500e-3, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+    _buffer_chunk = 4096  # points per TRCB? transfer
+    _buffer_size = 16383
+    buffer_rate = _scpi_property('SRAT', '{:d}')
+    buffer_loop = _scpi_property('SEND', '{:bool}')
+    buffer_points = property(_make_getter('SPTS?', '{:d}'))
+
+    def buffer_reset(self):
+        """Clear the data buffer"""
+        self.raw_write('REST')
+
+    def buffer_start(self):
+        """Start or resume storing data"""
+        self.raw_write('STRT')
+
+    def buffer_pause(self):
+        """Pause storing data"""
+        self.raw_write('PAUS')
+
+    def read_buffer(self, channel, start=0, count=None):
+        """Read `count` points of display `channel` (1 or 2) from the buffer.
+
+        Uses the binary TRCB? transfer, a few thousand points at a time, so
+        it is much faster than reading values one by one. count defaults to
+        everything from start to the end of the buffer."""
+        if count is None:
+            count = self.buffer_points - start
+        data = np.empty(max(count, 0))
+        done = 0
+        while done < count:
+            n = min(self._buffer_chunk, count - done)
+            with self.lock:
+                self.raw_write('TRCB? {},{},{}'.format(channel, start + done, n))
+                raw = self.raw_read_bytes(4 * n)
+            data[done:done+n] = np.frombuffer(raw, '<f4')
+            done += n
+        return data
+
+    def acquire(self, n_points, rate=13, xy=True):
+        """Fill the buffer with n_points at buffer_rate `rate` and read it.
+
+        With xy=True the displays are set to X and Y for the acquisition,
+        and put back afterwards, and the function returns (x, y) in volts,
+        otherwise the CH1 and CH2 display values. Blocks for n_points / sample rate seconds.
+        rate is the SRAT index 0 (62.5 mHz) to 13 (512 Hz); 14 (external
+        trigger) isn't supported here as there is no way to know when the
+        buffer will be full."""
+        if not 0 <= rate < len(self._sample_rates):
+            raise ValueError(f"rate must be 0 to {len(self._sample_rates) - 1}, not {rate}")
+        if not 0 < n_points <= self._buffer_size:
+            raise ValueError(f"The buffer holds 1 to {self._buffer_size} points, not {n_points}")
+        if xy:
+            displays = [self.raw_query(f'DDEF? {ch}') for ch in (1, 2)]  # e.g. '1,0'
+            if None in displays:
+                raise InstrumentDisconnectedError("SR830 did not answer DDEF?")
+            self.raw_write('DDEF 1,0,0')
+            self.raw_write('DDEF 2,0,0')
+        try:
+            self.buffer_rate = rate
+            self.buffer_loop = False
+            self.buffer_reset()
+            self.buffer_start()
+            time.sleep(n_points / self._sample_rates[rate])
+            while self.buffer_points < n_points:
+                time.sleep(0.1)
+            self.buffer_pause()
+            return self.read_buffer(1, 0, n_points), self.read_buffer(2, 0, n_points)
+        finally:
+            if xy:
+                for ch, display in zip((1, 2), displays):
+                    self.raw_write(f'DDEF {ch},{display}')
+
+
+class StanfordSR830(_SR830Acquisition, ScpiInstrument):
     """
     StanfordSR830
     =============
@@ -41,6 +140,10 @@ class StanfordSR830(ScpiInstrument):
     auto_reserve() : returns nothing
     next_sens(value) : returns int
     next_time_const(value) : returns int
+    snap(*params) : returns tuple of float
+    buffer_reset(), buffer_start(), buffer_pause() : return nothing
+    read_buffer(channel, start=0, count=None) : returns numpy array
+    acquire(n_points, rate=13) : returns two numpy arrays
 
     Properties
     ----------
@@ -52,6 +155,17 @@ class StanfordSR830(ScpiInstrument):
         measures the current R value, in volts
     meas_t : Get only, float
         measures the current \theta value, in degrees
+    meas_xy : Get only, tuple of float
+        X and Y in volts, sampled at the same instant
+    meas_rt : Get only, tuple of float
+        R in volts and \theta in degrees, sampled at the same instant
+
+    buffer_rate : Get and set, int
+        Sample rate of the data buffer, 0 (62.5 mHz) to 13 (512 Hz), 14 = trigger
+    buffer_loop : Get and set, boolean
+        True to overwrite the oldest points when the buffer is full, False to stop
+    buffer_points : Get only, int
+        Number of points stored in the data buffer
 
     ref_phas : Get and set, float
         The refernce phase, in degrees
@@ -221,6 +335,10 @@ class CTC100(Instrument):
         including input temperatures, output powers, AIO values and severeral
         more note reported elsewhere such as heater resistances. Exactly what
         is included depends on congifuration of the instrument.
+        Names and units are only asked for once and then cached. The cache
+        is dropped if all_vals comes back with a different number of values,
+        or by calling refresh_val_names() after reconfiguring the instrument.
+        measurement.quantity_from_ctc100 makes a Quantity of all of them.
     """
     _idnstring = "Stanford Research Systems, CTC100 Cryogenic Temperature Controller"
 
@@ -236,6 +354,8 @@ class CTC100(Instrument):
                        2: _CTC100_AIO(self, 2),
                        3: _CTC100_AIO(self, 3),
                        4: _CTC100_AIO(self, 4)}
+        self._val_names = None
+        self._val_units = None
 
     def raw_read(self):
         """Override to strip non-ascii chars"""
@@ -260,20 +380,34 @@ class CTC100(Instrument):
             s = "off"
         self.raw_write(f'outputEnable {s}')
 
+    def refresh_val_names(self):
+        """Forget the cached all_val_names and all_val_units"""
+        self._val_names = None
+        self._val_units = None
+
     @property
     def all_vals(self):
         resp = self.raw_query('getOutput?')
-        return np.genfromtxt(resp.split(','))
+        try:
+            vals = np.array(resp.split(','), dtype=float)
+        except ValueError:
+            # something non-numeric in there, let genfromtxt turn it into nan
+            vals = np.genfromtxt(resp.split(','))
+        if self._val_names is not None and len(vals) != len(self._val_names):
+            self.refresh_val_names()
+        return vals
 
     @property
     def all_val_names(self):
-        resp = self.raw_query('getOutput.names?')
-        resp_list = [r.strip() for r in resp.split(',')]
-        return resp_list
+        if self._val_names is None:
+            resp = self.raw_query('getOutput.names?')
+            self._val_names = [r.strip() for r in resp.split(',')]
+        return list(self._val_names)
 
     @property
     def all_val_units(self):
-        resp = self.raw_query('getOutput.units?')
-        resp_list = [r.strip() for r in resp.split(',')]
-        resp_list = ['-' if unit == '' else unit for unit in resp_list]
-        return resp_list
+        if self._val_units is None:
+            resp = self.raw_query('getOutput.units?')
+            resp_list = [r.strip() for r in resp.split(',')]
+            self._val_units = ['-' if unit == '' else unit for unit in resp_list]
+        return list(self._val_units)
@@ -8,10 +8,11 @@ Module for interfacing with Stanford SR830 Lock in amplifiers.
 """
 
 from . import ScpiInstrument, _make_getter, _scpi_property
+from .stanford import _SR830Acquisition
 import bisect
 
 
-class StanfordSR830(ScpiInstrument):
+class StanfordSR830(_SR830Acquisition, ScpiInstrument):
     """
     StanfordSR830
     =============
@@ -37,6 +38,10 @@ class StanfordSR830(ScpiInstrument):
     auto_reserve() : returns nothing
     next_sens(value) : returns int
     next_time_const(value) : returns int
+    snap(*params) : returns tuple of float
+    buffer_reset(), buffer_start(), buffer_pause() : return nothing
+    read_buffer(channel, start=0, count=None) : returns numpy array
+    acquire(n_points, rate=13) : returns two numpy arrays
 
     Dynamic Properties
     ----------
@@ -48,6 +53,17 @@ class StanfordSR830(ScpiInstrument):
         measures the current R value, in volts
     meas_t : Get only, float
         measures the current \theta value, in degrees
+    meas_xy : Get only, tuple of float
+        X and Y in volts, sampled at the same instant
+    meas_rt : Get only, tuple of float
+        R in volts and \theta in degrees, sampled at the same instant
+
+    buffer_rate : Get and set, int
+        Sample rate of the data buffer, 0 (62.5 mHz) to 13 (512 Hz), 14 = trigger
+    buffer_loop : Get and set, boolean
+        True to overwrite the oldest points when the buffer is full, False to stop
+    buffer_points : Get only, int
+        Number of points stored in the data buffer
 
     ref_phas : Get and set, float
         The refernce phase, in degrees
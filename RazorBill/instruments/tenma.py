@@ -9,7 +9,7 @@ supplies. Tenma are a Farnell own-brand, but I think these are the same as
 Korad units.
 """
 
-from . import Instrument
+from . import Instrument, InstrumentDisconnectedError
 
 
 class DC_7227xx(Instrument):
@@ -17,7 +17,6 @@ class DC_7227xx(Instrument):
 
     Developed with a 72-2705, probably suports most single channel supplies.
     """
-    # TODO: use STATUS? command to get CV or CC, and OCP status from status byte
 
     _idnstring = 'TENMA 72-27'
 
@@ -28,12 +27,49 @@ class DC_7227xx(Instrument):
         return lambda self, value: self.raw_write(f"{command}{int(value)}\n")
 
     def _make_float_getter(command):
-        return lambda self: float(self.raw_query(f"{command}?\n"))
+        def getter(self):
+            resp = self.raw_query(f"{command}?\n")
+            if resp is None:
+                raise InstrumentDisconnectedError(f"{self} is disconnected, use connect() to get it back")
+            return float(resp)
+        return getter
 
     current_limit = property(_make_float_getter('ISET1'), _make_float_setter('ISET1'))
     voltage_limit = property(_make_float_getter('VSET1'), _make_float_setter('VSET1'))
-    current_actual = property(_make_float_getter('IOUT1?'))
-    voltage_actual = property(_make_float_getter('VOUT1?'))
+    current_actual = property(_make_float_getter('IOUT1'))
+    voltage_actual = property(_make_float_getter('VOUT1'))
     output_enable = property(None, _make_bool_setter('OUT'))
     ocp_enable = property(None, _make_bool_setter('OCP'))
     keyboard_lock = property(None, _make_bool_setter('LOCK'))
+
+    @staticmethod
+    def decode_status(status_byte):
+        """Decode the byte returned by STATUS? into a dict of booleans.
+
+        'cv' is True in constant voltage and False in constant current mode.
+        """
+        return {'cv': bool(status_byte & 0x01),
+                'beep': bool(status_byte & 0x10),
+                'ocp': bool(status_byte & 0x20),
+                'output': bool(status_byte & 0x40),
+                'ovp': bool(status_byte & 0x80)}
+
+    def _read_status_byte(self):
+        """STATUS? answers with a single binary byte, which may well be a
+        whitespace or non-printing character, so it is read raw with
+        raw_read_bytes rather than through raw_read, which would strip it."""
+        with self.lock:
+            self.raw_write("STATUS?\n")
+            return self.raw_read_bytes()[0]
+
+    @property
+    def status(self):
+        """Output, OCP, OVP, beep and CV/CC state as a dict, see decode_status"""
+        return self.decode_status(self._read_status_byte())
+
+    @property
+    def telemetry(self):
+        """(voltage_actual, current_actual, status), read in one go under
+        the instrument lock so the three values belong together."""
+        with self.lock:
+            return self.voltage_actual, self.current_actual, self.status
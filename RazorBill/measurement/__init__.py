@@ -15,6 +15,7 @@ import __main__
 from ._logging import _setup_logging, _setup_exception_logging, _rootlogger
 from ._logging import ThreadWithExcLog  # NOQA for export
 from .config import data_path, log_path, kst_binary  # NOQA for export
+from . import transforms as _transforms
 
 _environment_is_setup = False
 logger = _rootlogger.getChild('user')  # for use in scripts. Use _logger within module
@@ -52,6 +53,9 @@ class Quantity():
         Example: 'Hz'. Will be written to the CSV file too
     scalefactor : number or itterable of numbers, optional
         The measured value will be multiplied by this before being returned
+    transforms : list of callables, optional
+        Applied in order after the scalefactor, for nonlinear conversions.
+        See measurement.transforms for tables, polynomials and clamping.
     skiptest : Boolean, optional
         Unless this is true, immediatly try getting data to test the source.
     quiet : Boolean, optional
@@ -75,7 +79,7 @@ class Quantity():
 
     Attributes
     ----------
-    `name`, `units` and `scalefactor` are as per the constructor.
+    `name`, `units`, `scalefactor` and `transforms` are as per the constructor.
 
     value : anything
         The value of the quanitiy at the moment the property is accessed.
@@ -83,10 +87,12 @@ class Quantity():
         an instrument which takes a physical measurment.
     """
 
-    def __init__(self, name, source, units, scalefactor=1, skiptest=False, quiet=False):
+    def __init__(self, name, source, units, scalefactor=1, skiptest=False, quiet=False,
+                 transforms=()):
         self.name = name
         self.units = units
         self.scalefactor = scalefactor
+        self.transforms = list(transforms)
         self.quiet = quiet
         self._has_warned = False
         if isinstance(name, list):
@@ -119,6 +125,7 @@ class Quantity():
                 val = list(np.multiply(self._get_value(), self.scalefactor))
             else:
                 val = self._get_value() * self.scalefactor
+            val = _transforms.apply(self.transforms, val)
             self._has_warned = False
             return val
         except Exception as e:
@@ -153,6 +160,29 @@ def quantity_from_scanner(scanner, suffixes=[" Cap", " Loss", " ExcVolt"], units
     return q
 
 
+def quantity_from_ctc100(ctc, skiptest=False):
+    """Build one list Quantity of every value a CTC100 reports.
+
+    Names and units come from the instrument, and each measurement is a
+    single getOutput? query. If the instrument's channels are reconfigured
+    the number of values changes, so make a new Quantity."""
+    names = ctc.all_val_names
+    units = ctc.all_val_units
+    q = Quantity(names, lambda: list(ctc.all_vals), units, [1] * len(names), skiptest)
+    return q
+
+
+def quantity_from_lakeshore(lakeshore, prefix='', skiptest=False):
+    """Build one list Quantity of all inputs (and heater and setpoints, for
+    controllers) of a Lakeshore218, 331 or 340, read with one query.
+
+    prefix is put in front of each name, to tell several instruments apart."""
+    names = [prefix + name for name in lakeshore.all_val_names]
+    units = lakeshore.all_val_units
+    q = Quantity(names, lambda: lakeshore.all_vals, units, [1] * len(names), skiptest)
+    return q
+
+
 class Quant_Checker():
     def __init__(self, quant, limits, action=None, index=None):
         """Check a quantity and low a warning if it is outside set limits.
@@ -0,0 +1,113 @@
+#
+# Copyright 2016-2021 Razorbill Instruments Ltd.
+# This file is part of the Razorbill Lab Python library which is
+# available under the MIT licence - see the LICENCE file for more.
+#
+"""
+Calibration transforms for measurement Quantities, for conversions which are
+not just a scalefactor, e.g. a thermometer or pressure gauge calibration.
+
+Each transform is a callable which takes a number or array and returns the
+converted value(s). Anything expensive, like fitting a spline through a
+table, is done once when the transform is made, and then every call is a
+vectorised numpy operation, so the same transform works on one reading, a
+list from a multi-value Quantity, or a whole streamed array.
+
+    t_cal = Table(volts, kelvin, kind='cubic')
+    q = Quantity('Temp', (ctc, 'In1'), 'K', transforms=[t_cal])
+
+or chain several, which are applied in order after the scalefactor:
+
+    transforms=[Polynomial([2.1, -0.3, 0]), Clamp(0, None)]
+"""
+
+import numpy as np
+
+
+class Table():
+    """
+    Interpolate in a lookup table.
+
+    Construction
+    ------------
+    x, y : array-like, required
+        The table. x must be increasing.
+    kind : string, optional
+        'linear' (default) or 'cubic'. Cubic needs scipy and is the same
+        spline as scipy's interp1d(kind='cubic').
+    log : Boolean, optional
+        Interpolate in log10(y), for y spanning many decades such as
+        pressure or resistance. y must be positive.
+    fill : number, optional
+        Returned for inputs outside the table, and for NaN. Default NaN.
+    """
+
+    def __init__(self, x, y, kind='linear', log=False, fill=np.nan):
+        self.x = np.asarray(x, float)
+        self.y = np.asarray(y, float)
+        self.kind = kind
+        self.log = log
+        self.fill = fill
+        if np.any(np.diff(self.x) <= 0):
+            raise ValueError("Table x values must be increasing")
+        self._y = np.log10(self.y) if log else self.y
+        if kind == 'cubic':
+            from scipy.interpolate import make_interp_spline
+            self._spline = make_interp_spline(self.x, self._y, k=3)
+        elif kind == 'linear':
+            self._spline = None
+        else:
+            raise ValueError(f"kind must be 'linear' or 'cubic', not '{kind}'")
+
+    def __call__(self, x):
+        x = np.asarray(x, float)
+        inside = (x >= self.x[0]) & (x <= self.x[-1])  # False for NaN too
+        if self._spline is None:
+            y = np.interp(x, self.x, self._y)
+        else:
+            y = self._spline(np.where(inside, x, self.x[0]))
+        if self.log:
+            y = np.power(10, y)
+        return np.where(inside, y, self.fill)
+
+
+class Polynomial():
+    """
+    Evaluate a polynomial. coeffs are highest power first, as for np.polyval
+    and np.polyfit, so a fit can be passed straight in.
+    """
+
+    def __init__(self, coeffs):
+        self.coeffs = np.asarray(coeffs, float)
+
+    def __call__(self, x):
+        return np.polyval(self.coeffs, np.asarray(x, float))
+
+
+class Clamp():
+    """
+    Limit values to between low and high. Either may be None for no limit.
+    NaN is passed through.
+    """
+
+    def __init__(self, low=None, high=None):
+        self.low = -np.inf if low is None else low
+        self.high = np.inf if high is None else high
+
+    def __call__(self, x):
+        return np.clip(np.asarray(x, float), self.low, self.high)
+
+
+def apply(transforms, value):
+    """Apply each transform in turn. Scalars come back as float, lists as
+    lists and arrays as arrays, to match what was passed in."""
+    if not transforms:
+        return value
+    result = np.asarray(value, float)
+    for transform in transforms:
+        result = transform(result)
+    if isinstance(value, np.ndarray):
+        return result
+    if isinstance(value, (list, tuple)):
+        return list(result)
+    return float(result)
@@ -0,0 +1,212 @@
+"""
+Acquisition and analysis worker process for the operations GUI.
+
+The worker owns the ILD, the ILDStreamRecorder and DischargeDetector and runs
+the shot analysis, so none of it competes with the GUI for the GIL. It is
+driven over an omnipy.bus channel:
+
+    'mark'  label=, value=, t=       record an event at wall time t
+    'shot'  shot=, value=, t=        mark 'ign' at t, wait for the discharge
+                                     and analyse it
+    'stop'                           finish queued work and close the sensor
+
+and replies 'ready', 'shot', 'error' and 'closed'. The arrays of each
+ShotResult go through a TraceSlots block of shared memory rather than being
+pickled onto the reply queue; only the scalars travel in the message.
+"""
+import time
+import queue
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from omnipy import analysis, collection
+
+ARRAYS = ('t', 'y', 'freqs', 'spectrum')  # ShotResult attributes sent through shared memory
+_run_ids = itertools.count(1)
+
+
+class TraceSlots:
+    """A ring of fixed-size float64 slots in shared memory.
+
+    The GUI makes it (name=None) and the worker attaches by name. put()
+    writes some arrays into the next slot and returns (slot, lengths) to
+    send in a message; get() copies them back out. Slots are reused round
+    robin, so the reader has to get() a slot before n_slots more are put.
+    """
+
+    def __init__(self, n_slots=4, slot_len=2**17, name=None):
+        self._owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self._owner, size=n_slots*slot_len*8)
+        self.name = self.shm.name
+        self.n_slots = n_slots
+        self.slot_len = slot_len
+        self.buf = np.ndarray((n_slots, slot_len), np.float64, self.shm.buf)
+        self._next = 0
+
+    def put(self, *arrays):
+        lengths = [len(a) for a in arrays]
+        if sum(lengths) > self.slot_len:
+            raise ValueError('%d samples do not fit in a slot of %d' % (sum(lengths), self.slot_len))
+        slot = self._next
+        self._next = (slot + 1) % self.n_slots
+        i = 0
+        for a, n in zip(arrays, lengths):
+            self.buf[slot, i:i+n] = a
+            i += n
+        return slot, lengths
+
+    def get(self, slot, lengths):
+        out = []
+        i = 0
+        for n in lengths:
+            out.append(self.buf[slot, i:i+n].copy())
+            i += n
+        return out
+
+    def close(self):
+        del self.buf  # the memory can't be closed while a numpy view exists
+        self.shm.close()
+        if self._owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:  # already gone with the worker's resource tracker
+                pass
+
+
+def worker(channel, port, filename, freqLaser, slots_name, n_slots, slot_len, **kwargs):
+    """Process target. kwargs are passed on to analysis.analyse_shot."""
+    from omnipy import control  # vendor drivers are only loaded in the worker
+    slots = TraceSlots(n_slots, slot_len, slots_name)
+    disp_sensor = recorder = None
+    try:
+        disp_sensor = control.ILD(port)
+        recorder = collection.ILDStreamRecorder(disp_sensor, filename, freqLaser)
+        detector = analysis.DischargeDetector(freqLaser)
+        recorder.listeners.append(detector.feed)
+        channel.reply('ready', data_file=recorder.data_file)
+        while True:
+            msg = channel.recv()
+            if msg.command == 'mark':
+                recorder.mark(msg.args['label'], msg.args.get('value', ''), msg.args.get('t'))
+            elif msg.command == 'shot':
+                _shot(channel, msg.args, recorder, detector, slots, freqLaser, kwargs)
+            elif msg.command == 'stop':
+                break
+    except Exception as e:
+        channel.reply('error', text=repr(e))
+    finally:
+        if recorder is not None:
+            recorder.stop()
+        if disp_sensor is not None:
+            disp_sensor.close()
+        slots.close()
+        channel.reply('closed')
+
+
+def _shot(channel, args, recorder, detector, slots, freqLaser, kwargs):
+    sample = recorder.mark('ign', args.get('value', ''), args['t'])
+    reply = dict(shot=args.get('shot'), value=args.get('value'))
+    try:
+        # Fit as soon as the post-discharge window is complete. If no discharge
+        # is seen, centre the windows on the ignition pulse.
+        deadline = args['t'] + detector.windows[3] + 5
+        discharge = None
+        while discharge is None:
+            try:
+                event = detector.events.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                print('no discharge detected')
+                discharge = detector.discharge_at(sample)
+                break
+            if event.sample >= sample - freqLaser:  # older ones belong to earlier shots
+                discharge = event
+        shot_data = recorder.samples_between(discharge.first, discharge.stop)
+        result = analysis.analyse_discharge(shot_data, discharge, freqLaser, **kwargs)
+        slot, lengths = slots.put(*(getattr(result, a) for a in ARRAYS))
+        fields = {k: v for k, v in vars(result).items() if k not in ARRAYS}
+        channel.reply('shot', slot=slot, lengths=lengths, fields=fields, **reply)
+    except Exception as e:
+        channel.reply('shot', error=repr(e), **reply)
+
+
+class AcquisitionProcess:
+    """GUI side handle: starts the worker and rebuilds its ShotResults.
+
+    Each one gets its own bus channel, 'acq-1', 'acq-2'..., so replies from
+    a worker that is still shutting down can be told apart from the next
+    one's by msg.sender.
+    """
+
+    def __init__(self, bus, port, filename, freqLaser=2000, name=None, n_slots=4, slot_len=2**17, **kwargs):
+        self.bus = bus
+        self.name = name or 'acq-%d' % next(_run_ids)
+        self.data_file = filename + '.bin'
+        self.slots = TraceSlots(n_slots, slot_len)
+        self.process = multiprocessing.Process(
+            target=worker, name=name, daemon=True,
+            args=(bus.channel(self.name), port, filename, freqLaser, self.slots.name, n_slots, slot_len),
+            kwargs=kwargs)
+        self.process.start()
+
+    def send(self, command, **args):
+        self.bus.send(self.name, command, **args)
+
+    def result(self, msg):
+        """ShotResult from a 'shot' reply, or None if the analysis failed."""
+        if 'error' in msg.args:
+            return None
+        result = analysis.ShotResult.__new__(analysis.ShotResult)
+        result.__dict__.update(msg.args['fields'])
+        for a, values in zip(ARRAYS, self.slots.get(msg.args['slot'], msg.args['lengths'])):
+            setattr(result, a, values)
+        return result
+
+    def close(self, timeout=10):
+        """Stop the worker if it hasn't been told to already and wait for it
+        to close the sensor and exit, terminating it after timeout s."""
+        if self.name in self.bus.names():
+            self.send('stop')
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.bus.remove(self.name)
+        self.slots.close()
+
+
+if __name__ == '__main__':
+    # Run a shot with no detectable discharge through the worker's analysis,
+    # so the fallback window has to come from the .bin file:
+    #     python -m omnipy.acquisition
+    import os
+    import tempfile
+
+    class FakeILD:
+        """A pendulum swinging steadily, delivered like the ILD's buffer."""
+        def __init__(self, rate):
+            self.rate = rate
+            self.start = self.last = time.time()
+
+        def block_data(self):
+            now = time.time()
+            n = np.arange(int((self.last - self.start)*self.rate), int((now - self.start)*self.rate))
+            self.last = now
+            return 0.2*np.sin(2*np.pi*1.1*n/self.rate)
+
+    class Replies:
+        def reply(self, command, **args):
+            self.command, self.args = command, args
+
+    freqLaser = 2000
+    filename = os.path.join(tempfile.mkdtemp(), 'check')
+    recorder = collection.ILDStreamRecorder(FakeILD(freqLaser), filename, freqLaser, tail_seconds=2)
+    detector = analysis.DischargeDetector(freqLaser, frequency=1.1, windows=(-1, -0.2, 0.2, 1))
+    recorder.listeners.append(detector.feed)
+    slots = TraceSlots(2, 2**15)
+    time.sleep(1.5)
+    replies = Replies()
+    _shot(replies, {'shot': 1, 't': time.time()}, recorder, detector, slots, freqLaser, {})
+    recorder.stop()
+    slots.close()
+    print(replies.command, {k: v for k, v in replies.args.items() if k != 'fields'})
+    assert 'error' not in replies.args, replies.args['error']
@@ -1,9 +1,9 @@
 import numpy as np
-import pandas as pd
 import time
-from scipy.signal import find_peaks
-from scipy.fft import fft, fftfreq
-from scipy.optimize import curve_fit
+import queue
+from collections import namedtuple
+from scipy.signal import get_window
+from scipy.fft import rfft, rfftfreq
 
 
 
@@ -24,42 +24,200 @@ class fitClass:
         #return Dump*np.sin(w*t+phi)
         return A*np.sin(w*t+phi)
 
-def fitting_before (peak_number_after_discharge,df,frqY):
-    #BEFORE DISCHARGE
-    #TIMESTAP DEFINITION
-    timeStart1=-3
-    timeStop1=-0.2
+SineFit = namedtuple('SineFit', ['amplitude', 'phase', 'frequency', 'coeffs', 'cov',
+                                 'amplitude_err', 'phase_err', 'frequency_err', 'rms'])
+SineFit.__doc__ = """Result of fit_sinusoid. Every field has the batch shape of the input.
 
-    timeStart2=0.2
-    timeStop2=3
-    
-#CURVE FIT
-    df_aux1=df.drop(df[df['Time [s]'] > timeStop1].index)
-    df_aux1.drop(df_aux1[df_aux1['Time [s]'] < timeStart1].index, inplace=True)
+amplitude, phase : A and phi of A*sin(w*t+phi) (A >= 0)
+frequency : the fixed frequency, or the refined one if refine > 0
+coeffs : (..., 2) a, b of a*sin(w*t) + b*cos(w*t), i.e. A*cos(phi), A*sin(phi)
+cov : (..., 2, 2) covariance of coeffs
+amplitude_err, phase_err, frequency_err : one sigma uncertainties
+rms : rms of the residuals
+"""
 
-    y_1=df_aux1['Distance'].to_numpy()
-    x_1=df_aux1['Time [s]'].to_numpy()
-    
-    
-    x_fit_1=np.linspace(timeStart1,timeStop1,num=1000)
-    
-    df_aux2=df.drop(df[df['Time [s]'] > timeStop2].index)
-    df_aux2.drop(df_aux2[df_aux2['Time [s]'] < timeStart2].index, inplace=True)
-    
-    y_2=df_aux2['Distance'].to_numpy()
-    x_2=df_aux2['Time [s]'].to_numpy()
 
-    x_fit_2=np.linspace(timeStart2,timeStop2,num=1000)
-    
+def _sine_basis(t, w, damping):
+    env = np.exp(-damping*t)
+    return env*np.sin(w*t), env*np.cos(w*t)
+
+def _normal_solve(cols, y, mask):
+    """Solve the weighted normal equations for every fit in the batch at once."""
+    X = np.stack(cols, axis=-1)*mask[..., None]
+    G = np.einsum('...ni,...nj->...ij', X, X)
+    r = np.einsum('...ni,...n->...i', X, y*mask)
+    return np.linalg.solve(G, r[..., None])[..., 0], G
+
+def fit_sinusoid(t, y, f, damping=0.0, refine=0, mask=None):
+    """Linear least squares fit of exp(-damping*t)*A*sin(2*pi*f*t+phi).
+
+    With f (and damping) fixed the model is linear in a = A*cos(phi) and
+    b = A*sin(phi), so there is no iteration and no initial guess needed.
+    t and y are (..., n) arrays and any leading axes are fitted as a batch in
+    one call, f and damping can be scalars or have the batch shape. mask is
+    (..., n) and zero where a sample should be ignored, which is how windows
+    of different lengths are padded into one batch (see fit_windows).
+    refine > 0 runs that many Gauss-Newton steps re-estimating f as well.
+    """
+    y = np.asarray(y, dtype=float)
+    t = np.broadcast_to(np.asarray(t, dtype=float), y.shape)
+    mask = np.ones(y.shape) if mask is None else np.broadcast_to(np.asarray(mask, dtype=float), y.shape)
+    w = 2*np.pi*np.broadcast_to(np.asarray(f, dtype=float), y.shape[:-1]).copy()
+    damping = np.asarray(damping, dtype=float)[..., None]
+
+    s, c = _sine_basis(t, w[..., None], damping)
+    coeffs, G = _normal_solve((s, c), y, mask)
+    frequency_err = np.zeros(w.shape)
+    for i in range(refine):
+        a, b = coeffs[..., 0:1], coeffs[..., 1:2]
+        resid = y - a*s - b*c
+        dw = t*(a*c - b*s)  # derivative of the model with respect to w
+        step, _ = _normal_solve((s, c, dw), resid, mask)
+        w = w + step[..., 2]
+        s, c = _sine_basis(t, w[..., None], damping)
+        coeffs, G = _normal_solve((s, c), y, mask)
+
+    resid = (y - coeffs[..., 0:1]*s - coeffs[..., 1:2]*c)*mask
+    n = mask.sum(axis=-1)
+    dof = np.maximum(n - 2 - (refine > 0), 1)
+    sigma2 = (resid**2).sum(axis=-1)/dof
+    cov = np.linalg.inv(G)*sigma2[..., None, None]
+    if refine:
+        # f is correlated with the phase, so take (a, b) errors from the 3 parameter fit
+        a, b = coeffs[..., 0:1], coeffs[..., 1:2]
+        _, G3 = _normal_solve((s, c, t*(a*c - b*s)), y, mask)
+        cov3 = np.linalg.inv(G3)*sigma2[..., None, None]
+        cov = cov3[..., :2, :2]
+        frequency_err = np.sqrt(cov3[..., 2, 2])/(2*np.pi)
+
+    a, b = coeffs[..., 0], coeffs[..., 1]
+    A = np.hypot(a, b)
+    # propagate the covariance of (a, b) through A = |a+ib|, phi = arg(a+ib)
+    var_a, var_b, cov_ab = cov[..., 0, 0], cov[..., 1, 1], cov[..., 0, 1]
+    amplitude_err = np.sqrt((a*a*var_a + b*b*var_b + 2*a*b*cov_ab))/A
+    phase_err = np.sqrt((b*b*var_a + a*a*var_b - 2*a*b*cov_ab))/A**2
+    return SineFit(A, np.arctan2(b, a), w/(2*np.pi), coeffs, cov,
+                   amplitude_err, phase_err, frequency_err, np.sqrt((resid**2).sum(axis=-1)/n))
+
+def fit_windows(windows, f, damping=0.0, refine=0):
+    """Fit several (t, y) windows of possibly different lengths in one batch.
+
+    f and damping are scalars or one value per window.
+    """
+    nmax = max(len(t) for t, y in windows)
+    tt = np.zeros((len(windows), nmax))
+    yy = np.zeros((len(windows), nmax))
+    mask = np.zeros((len(windows), nmax))
+    for i, (t, y) in enumerate(windows):
+        tt[i, :len(t)] = t
+        yy[i, :len(y)] = y
+        mask[i, :len(t)] = 1
+    return fit_sinusoid(tt, yy, f, damping, refine, mask)
+
+def kick_amplitude(fit, before=0, after=1):
+    """Vector difference B between two fits in a batch, with its uncertainty.
+
+    B is the amplitude of the oscillation which, added to the motion before
+    the discharge, gives the motion after it.
+    """
+    d = fit.coeffs[..., before, :] - fit.coeffs[..., after, :]
+    cov = fit.cov[..., before, :, :] + fit.cov[..., after, :, :]
+    B = np.hypot(d[..., 0], d[..., 1])
+    B_err = np.sqrt(np.einsum('...i,...ij,...j->...', d, cov, d))/B
+    return B, B_err
+
+FreqEstimate = namedtuple('FreqEstimate', ['frequency', 'uncertainty', 'amplitude', 'freqs', 'spectrum'])
+FreqEstimate.__doc__ = """Result of FrequencyEstimator.estimate.
+
+frequency, uncertainty : interpolated peak frequency and its one sigma error, Hz
+amplitude : amplitude of the peak, in the units of the data
+freqs, spectrum : the single sided amplitude spectrum, for plotting
+"""
+
+
+class FrequencyEstimator:
+    """Find the dominant frequency in a trace to a fraction of an FFT bin.
+
+    Uses an rfft, optionally windowed and zero padded, and interpolates the
+    peak with a parabola through the log magnitudes ('parabolic') or with
+    Jacobsen's complex estimator ('jacobsen'). Jacobsen is for an unpadded,
+    unwindowed rfft, use parabolic with a window and/or padding. Window, frequency axis and
+    the padded scratch buffer are kept for each trace length, so repeated
+    shots of the same length don't reallocate them. FFT plans are not cached
+    here: scipy.fft (pocketfft) keeps its own cache of recently used lengths,
+    which is all the reuse there is.
+    """
+
+    def __init__(self, freqLaser, pad=1, window=None, method='jacobsen', fmin=0.0):
+        self.fs = freqLaser
+        self.pad = pad
+        self.window = window
+        self.method = method
+        self.fmin = fmin
+        self._cache = {}
+
+    def _setup(self, N):
+        if N not in self._cache:
+            nfft = int(N*self.pad)
+            win = np.ones(N) if self.window is None else get_window(self.window, N)
+            self._cache[N] = (nfft, win, win.sum(), np.zeros(nfft), rfftfreq(nfft, 1/self.fs),
+                              -2j*np.pi*np.arange(N))
+        return self._cache[N]
+
+    def estimate(self, y):
+        N = len(y)
+        nfft, win, gain, scratch, freqs, phase = self._setup(N)
+        np.multiply(y, win, out=scratch[:N])  # rest of scratch stays zero padding
+        Y = rfft(scratch)
+        mag = np.abs(Y)
+        spectrum = 2.0/gain*mag
+
+        k0 = max(int(np.ceil(self.fmin*nfft/self.fs)), 1)
+        k = k0 + np.argmax(mag[k0:-1])
+        if self.method == 'parabolic':
+            a, b, c = np.log(mag[k-1:k+2] + 1e-300)
+            delta = 0.5*(a - c)/(a - 2*b + c)
+        elif self.method == 'jacobsen':
+            delta = -np.real((Y[k+1] - Y[k-1])/(2*Y[k] - Y[k-1] - Y[k+1]))
+        else:
+            raise ValueError('Unknown interpolation method ' + repr(self.method))
+        frequency = (k + delta)*self.fs/nfft
+
+        # Amplitude at the interpolated peak rather than the peak bin, which is
+        # low by up to the scalloping loss when the peak falls between bins.
+        amplitude = 2.0/gain*np.abs(np.dot(scratch[:N], np.exp(phase*(k + delta)/nfft)))
+
+        # Cramer-Rao lower bound for a real sinusoid in white noise, with
+        # SNR = A**2/(2 sigma**2). The noise bins are Rayleigh distributed, so
+        # the median magnitude gives the noise level.
+        sigma2 = np.median(mag)**2/(np.log(2)*np.sum(win**2))
+        uncertainty = self.fs/(2*np.pi)*np.sqrt(12*sigma2/((amplitude**2/2)*N*(N**2 - 1)))
+        return FreqEstimate(frequency, uncertainty, amplitude, freqs, spectrum)
+
+_estimators = {}  # one per sample rate, shared by Raw_Data_Collection calls
+
+def window(t, y, start, stop):
+    """Return views of t and y for start <= t <= stop. t must be sorted."""
+    i0 = np.searchsorted(t, start, side='left')
+    i1 = np.searchsorted(t, stop, side='right')
+    return t[i0:i1], y[i0:i1]
+
+def fitting_before (peak_number_after_discharge,t,y,frqY,timeStart1=-3,timeStop1=-0.2,timeStart2=0.2,timeStop2=3):
+    #BEFORE AND AFTER DISCHARGE
+    #t and y are numpy arrays, t sorted and centred on the discharge
+
+#CURVE FIT
+    x_1, y_1 = window(t, y, timeStart1, timeStop1)
+    x_2, y_2 = window(t, y, timeStart2, timeStop2)
 
     inst = fitClass()
     inst.f = frqY
-    coeffs1, coeffs_cov1 = curve_fit(inst.funcSin, x_1, 1000*y_1)
+    fit = fit_windows([(x_1, 1000*y_1), (x_2, 1000*y_2)], frqY)
+    coeffs1 = np.array([fit.amplitude[0], fit.phase[0]])
     print('f=%0.2f Hz, A=%0.2f um, phase=%0.2f rad'%(frqY,coeffs1[0],coeffs1[1]))
 
-    coeffs2, coeffs_cov2 = curve_fit(inst.funcSin, x_2, 1000*y_2)
+    coeffs2 = np.array([fit.amplitude[1], fit.phase[1]])
     print('f=%0.2f Hz, A=%0.2f um, phase=%0.2f rad'%(frqY,coeffs2[0],coeffs2[1]))
-    #,bounds=(0,[600.,360.,0.5]))
     x_fit_1=np.linspace(timeStart1,timeStop1,num=10000)
     x_fit_2=np.linspace(timeStart2,timeStop2,num=10000)
     
@@ -77,84 +235,221 @@ def fitting_before (peak_number_after_discharge,df,frqY):
     B=0
     B=np.sqrt((c1-c2)**2+(s1-s2)**2)
     
-    return x_fit_1, x_fit_2, coeffs1, coeffs2, B, inst, timeStart1, timeStop2
+    return x_fit_1, x_fit_2, coeffs1, coeffs2, B, inst, timeStart1, timeStop2, fit
+
+class ShotResult:
+    """Everything the analysis of one shot produced.
 
-def Raw_Data_Collection(disp_sensor,step,freqLaser, ax, cx):
+    Holds plain numpy arrays and numbers only, no matplotlib objects, so it
+    can be handed to the GUI thread (see utils.ShotRenderer) or pickled.
+    """
+
+    def __init__(self, t, y, est, coeffs1, coeffs2, B, bit, residuals, analysis_time):
+        self.t = t                          # s, relative to the discharge
+        self.y = y                          # mm, mean removed
+        self.freqs = est.freqs              # Hz
+        self.spectrum = est.spectrum        # mm
+        self.frequency = est.frequency      # Hz
+        self.frequency_err = est.uncertainty
+        self.coeffs1 = coeffs1              # [A um, phi rad] before discharge
+        self.coeffs2 = coeffs2              # [A um, phi rad] after discharge
+        self.B = B                          # um
+        self.bit = bit
+        self.residuals = residuals          # rms of the before/after fits, um
+        self.amplitude = (y.max()-y.min())/2 if len(y) else np.nan  # mm
+        self.analysis_time = analysis_time  # s
+
+def analyse_shot(t, y, freqLaser, estimator=None, mp=5e-6, L=0.1, windows=(-3, -0.2, 0.2, 3)):
+    """Frequency estimate, before/after fits, B and Ibit for one shot.
+
+    t is in seconds relative to the discharge and y in mm with the mean
+    removed. windows are (start1, stop1, start2, stop2) in seconds.
+    """
+    start = time.perf_counter()
+    if estimator is None:
+        estimator = _estimators.setdefault(freqLaser, FrequencyEstimator(freqLaser))
+    est = estimator.estimate(y)
+    frqY = est.frequency # Get the actual frequency value
+    print('f=%0.4f Hz +/- %0.2g Hz'%(frqY,est.uncertainty))
+
+    (x_fit_1, x_fit_2, coeffs1, coeffs2, B, inst,timeStart1, timeStop2, fit)= fitting_before(1,t,y,frqY,*windows)
+
+    bit = Ibit(mp,L,B)
+    return ShotResult(t, y, est, coeffs1, coeffs2, B, bit, fit.rms, time.perf_counter()-start)
+
+def Raw_Data_Collection(disp_sensor,step,freqLaser, estimator=None):
 
     print('process start')
     time.sleep(step/2)
     
-    raw_data = pd.DataFrame()
-    raw_data['1'] = disp_sensor.block_data()
-    #print(raw_data)
+    raw_data = np.asarray(disp_sensor.block_data(), dtype=float)
 
     dt=1/freqLaser
+    N = step*freqLaser
 
-    df = pd.DataFrame()
+    # last `step` seconds, with the mean removed from both distance and time
+    # so that the fit windows are relative to the middle of the trace
+    y = raw_data[len(raw_data)-N:]
+    y = y - y.mean()
+    t = np.arange(len(y))*dt
+    t -= t.mean()
 
-    df["Distance"] = raw_data[(len(raw_data['1'])-step*freqLaser):len(raw_data['1']-1)]
-    tfinal=dt*step*freqLaser
-    df["Time [s]"] = np.arange(0,tfinal,dt)
-    offset=df.mean()
-    df= (df-offset)
-    
-    
-    #plot results
-    print('plot reached')
-    ax.cla()                    # clear the subplot
-    ax.grid()
-    ax.plot(df["Time [s]"],df["Distance"],'r-',lw='1',label='raw data')
-    print(df["Time [s]"],df["Distance"])
-    #plt.xlim(4,5.5)
-    ax.legend(loc='best')
-
-    amplitude=(df['Distance'].max()-df['Distance'].min())/2 #millimeter
-    print('Max Amplitude = %0.2f mm'%amplitude)
-
-    y=df['Distance'].to_numpy()
-    x=df['Time [s]'].to_numpy()
-
-    # Number of sample points
-    N = len(x)
-    # sample spacing
-    T = dt
-    yf = fft(y)
-    xf = fftfreq(N, T)[:N//2]
-
-    peakY = np.max(2.0/N * np.abs(yf[0:N//2])) # Find max peak
-    locY = np.argmax(2.0/N * np.abs(yf[0:N//2])) # Find its location
-    frqY = xf[locY] # Get the actual frequency value
-    T=1/frqY #Get period
-    
-    
-    
-    cx.cla()                    # clear the subplot
-    cx.grid()
-    cx.semilogx(xf, 2.0/N * np.abs(yf[0:N//2]),label='Peak=%0.2f Hz'%frqY)
-    cx.legend(loc='best')
-    peaks, _ = find_peaks(df['Distance'], height=0, distance=1000)
-    np.diff(peaks)
-    #plt.plot(df['Time [s]'],df['Distance'], "-")
-    #plt.plot(df['Time [s]'][peaks],df['Distance'][peaks], "x")
-
-    shots = [None]*peaks.size
-    matrix = {}
-    h     = 0
-    x     = 0
-    count = 0 
-
-    (x_fit_1, x_fit_2, coeffs1, coeffs2, B, inst,timeStart1, timeStop2)= fitting_before(x+1,df,frqY)
-    
-    mp= 5e-6
-    L = 0.1
-    
-    bit = Ibit(mp,L,B)
-    
-    #Update display
-    #Log values
-    
-    
-    return B, bit
+    result = analyse_shot(t, y, freqLaser, estimator)
+    print('Max Amplitude = %0.2f mm'%result.amplitude)
+    return result
+
+
+Discharge = namedtuple('Discharge', ['sample', 'size', 'first', 'stop'])
+Discharge.__doc__ = """A discharge found by DischargeDetector.
+
+sample : stream index of the kick
+size : size of the jump in the oscillation phasor, in data units (roughly B)
+first, stop : stream indices spanning both fit windows, stop exclusive
+"""
+
+
+class DischargeDetector:
+    """Find the discharge kick in the live ILD stream as samples arrive.
+
+    The trace is demodulated at the pendulum frequency and the mean phasor
+    over the last period is compared with the period before it. Free
+    oscillation gives a near constant phasor, the discharge changes the
+    amplitude and/or phase, and the difference peaks exactly one period
+    after the kick. Running sums over a ring buffer make each sample O(1).
+
+    Feed it chunks with feed(). Once the post-discharge fit window is
+    complete the Discharge is returned from feed(), put on self.events and
+    passed to any callbacks, so the fit can start straight away.
+
+    freqLaser : sample rate, Hz
+    frequency : pendulum frequency, Hz. If None it is estimated from the
+        first `settle` seconds of data.
+    windows : fit windows (start1, stop1, start2, stop2), s from the kick
+    k : detection threshold in standard deviations of the running noise
+    min_size : smallest jump to count as a discharge, in data units
+    """
+
+    def __init__(self, freqLaser, frequency=None, windows=(-3, -0.2, 0.2, 3), k=10,
+                 min_size=0.005, settle=10, tau=20):
+        self.fs = freqLaser
+        self.windows = windows
+        self.k = k
+        self.min_size = min_size
+        self.settle = int(settle*freqLaser)
+        self.alpha = 1/(tau*freqLaser)  # dc tracking
+        self.events = queue.Queue()
+        self.callbacks = []
+        self.n = 0
+        self.frequency = None
+        self._startup = []
+        self._pending = []
+        if frequency is not None:
+            self.set_frequency(frequency)
+
+    def set_frequency(self, frequency):
+        """Set the demodulation frequency. Restarts the detector state."""
+        if not np.isfinite(frequency) or frequency <= 0:
+            raise ValueError('Demodulation frequency must be finite and positive, not %r' % frequency)
+        self.frequency = frequency
+        self.M = M = max(int(round(self.fs/frequency)), 1)
+        self._rot = np.exp(-2j*np.pi*frequency/self.fs)
+        self._lo = 1 + 0j
+        self._ring = np.zeros(2*M, dtype=complex)
+        self._filled = 0
+        self._new = self._old = 0j
+        self._dc = None
+        self._mean = self._var = None
+        self._peak = None
+        self._holdoff = 0
+
+    def feed(self, chunk, first=None):
+        """Process new samples. first is the stream index of chunk[0], if known."""
+        if first is not None:
+            self.n = first
+        found = []
+        if self.frequency is None:
+            self._startup.extend(chunk)
+            self.n += len(chunk)
+            if len(self._startup) >= self.settle:
+                y = np.asarray(self._startup)
+                self._startup = []
+                try:
+                    self.set_frequency(FrequencyEstimator(self.fs).estimate(y - y.mean()).frequency)
+                except ValueError as e:
+                    print('no pendulum frequency in start-up trace, trying again:', e)
+            return found
+        for y in chunk:
+            self._step(y)
+            self.n += 1
+            while self._pending and self.n >= self._pending[0].stop:
+                found.append(self._pending.pop(0))
+        for discharge in found:
+            self.events.put(discharge)
+            for callback in self.callbacks:
+                callback(discharge)
+        return found
+
+    def _step(self, y):
+        M = self.M
+        if self._dc is None:
+            self._dc = y
+        self._dc += self.alpha*(y - self._dc)
+        z = (y - self._dc)*self._lo
+        self._lo *= self._rot
+        j = self.n % (2*M)
+        mid = self._ring[(j + M) % (2*M)]  # moves from the newer period to the older
+        self._new += z - mid
+        self._old += mid - self._ring[j]
+        self._ring[j] = z
+        if j == 2*M - 1:
+            # stop rounding errors building up in the running sums, O(1) amortised
+            self._lo /= abs(self._lo)
+            self._ring_sums(j)
+        if self._filled < 2*M:
+            self._filled += 1
+            return
+        if self.n < self._holdoff:
+            return
+
+        # A small error in the frequency makes the phasor turn slowly, which
+        # gives D a steady offset, so look for D rising above its running mean
+        D = 2*abs(self._new - self._old)/M
+        if self._mean is None:
+            self._mean, self._var = D, 0.0
+        threshold = self._mean + max(self.k*np.sqrt(self._var), self.min_size)
+        if D > threshold:
+            if self._peak is None or D > self._peak[1]:
+                self._peak = (self.n, D)
+        elif self._peak is None:
+            diff = D - self._mean
+            self._mean += diff/(4*M)
+            self._var += (diff*diff - self._var)/(4*M)
+        if self._peak is not None and (D - self._mean < (self._peak[1] - self._mean)/2
+                                       or self.n - self._peak[0] > M):
+            sample = self._peak[0] - M + 1  # newest period starts at the kick
+            discharge = self.discharge_at(sample, self._peak[1] - self._mean)
+            self._pending.append(discharge)
+            self._peak = None
+            self._holdoff = discharge.stop + 2*M
+
+    def discharge_at(self, sample, size=np.nan):
+        """Discharge with this detector's windows at a known sample, e.g. the
+        ignition marker when nothing was detected."""
+        first = sample + int(round(self.windows[0]*self.fs))
+        stop = sample + int(round(self.windows[3]*self.fs)) + 1
+        return Discharge(sample, size, first, stop)
+
+    def _ring_sums(self, j):
+        M = self.M
+        order = np.roll(self._ring, -(j + 1))  # oldest first
+        self._old = order[:M].sum()
+        self._new = order[M:].sum()
+
+def analyse_discharge(y, discharge, freqLaser, estimator=None, **kwargs):
+    """analyse_shot on samples discharge.first to discharge.stop of the stream."""
+    y = np.asarray(y, dtype=float)
+    t = (np.arange(len(y)) + discharge.first - discharge.sample)/freqLaser
+    return analyse_shot(t, y - y.mean(), freqLaser, estimator, **kwargs)
 
 
 def closest(lst, K):
@@ -0,0 +1,96 @@
+"""
+Benchmarks for the omnipy analysis pipeline, run on synthetic shots so no
+hardware is needed.
+
+    python -m omnipy.bench
+"""
+import io
+import time
+import contextlib
+import numpy as np
+from scipy.optimize import curve_fit
+from omnipy import analysis
+
+
+def synthetic_shot(step=6, freqLaser=2000, f=1.1, A=0.2, kick=0.05, noise=0.002, seed=0):
+    """Pendulum trace in mm with a velocity kick half way through.
+
+    Returns (t, y) the way Raw_Data_Collection prepares them: the last `step`
+    seconds with the mean removed from both time and distance.
+    """
+    rng = np.random.default_rng(seed)
+    N = step*freqLaser
+    t = np.arange(N)/freqLaser
+    t -= t.mean()
+    w = 2*np.pi*f
+    y = A*np.sin(w*t + 0.3)
+    after = t > 0
+    y[after] += kick*np.sin(w*t[after])
+    y += noise*rng.standard_normal(N)
+    return t, y - y.mean()
+
+
+def _legacy_fitting_before(df, frqY):
+    """The DataFrame windowing and curve_fit used before omnipy.analysis went numpy-only."""
+    timeStart1, timeStop1, timeStart2, timeStop2 = -3, -0.2, 0.2, 3
+    df_aux1 = df.drop(df[df['Time [s]'] > timeStop1].index)
+    df_aux1.drop(df_aux1[df_aux1['Time [s]'] < timeStart1].index, inplace=True)
+    df_aux2 = df.drop(df[df['Time [s]'] > timeStop2].index)
+    df_aux2.drop(df_aux2[df_aux2['Time [s]'] < timeStart2].index, inplace=True)
+    inst = analysis.fitClass()
+    inst.f = frqY
+    coeffs1, _ = curve_fit(inst.funcSin, df_aux1['Time [s]'].to_numpy(), 1000*df_aux1['Distance'].to_numpy())
+    coeffs2, _ = curve_fit(inst.funcSin, df_aux2['Time [s]'].to_numpy(), 1000*df_aux2['Distance'].to_numpy())
+    c = coeffs1[0]*np.exp(1j*coeffs1[1]) - coeffs2[0]*np.exp(1j*coeffs2[1])
+    return np.abs(c)
+
+
+def _per_shot(func, repeats):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # analysis prints per fit
+        for _ in range(repeats):
+            result = func()
+    return (time.perf_counter() - start)/repeats, result
+
+
+def bench_windowing(repeats=50, frqY=1.1):
+    """Per-shot cost of windowing + fitting, pandas DataFrames vs numpy views."""
+    import pandas as pd
+    t, y = synthetic_shot(f=frqY)
+    df = pd.DataFrame({'Distance': y, 'Time [s]': t})
+    legacy, B_legacy = _per_shot(lambda: _legacy_fitting_before(df, frqY), repeats)
+    numpy_, out = _per_shot(lambda: analysis.fitting_before(1, t, y, frqY), repeats)
+    B = out[4]
+    print('windowing + fit, per shot:')
+    print('  pandas  %8.2f ms  B=%0.4f um' % (legacy*1e3, B_legacy))
+    print('  numpy   %8.2f ms  B=%0.4f um' % (numpy_*1e3, B))
+    return legacy, numpy_
+
+
+def bench_fitting(n_shots=100, frqY=1.1):
+    """curve_fit one window at a time vs one batched linear fit of every window."""
+    windows = []
+    for seed in range(n_shots):
+        t, y = synthetic_shot(f=frqY, seed=seed)
+        windows.append(analysis.window(t, 1000*y, -3, -0.2))
+        windows.append(analysis.window(t, 1000*y, 0.2, 3))
+    inst = analysis.fitClass()
+    inst.f = frqY
+    start = time.perf_counter()
+    for t, y in windows:
+        curve_fit(inst.funcSin, t, y)
+    iterative = time.perf_counter() - start
+    start = time.perf_counter()
+    fit = analysis.fit_windows(windows, frqY)
+    d = fit.coeffs.reshape(n_shots, 2, 2)
+    B = np.hypot(*(d[:, 0] - d[:, 1]).T)
+    batched = time.perf_counter() - start
+    print('fitting %d shots (%d windows):' % (n_shots, len(windows)))
+    print('  curve_fit  %8.2f ms per shot' % (iterative/n_shots*1e3))
+    print('  batched    %8.2f ms per shot  mean B=%0.3f um' % (batched/n_shots*1e3, B.mean()))
+    return iterative, batched
+
+
+if __name__ == '__main__':
+    bench_windowing()
+    bench_fitting()
@@ -0,0 +1,92 @@
+"""
+Message bus between the operations GUI and its workers.
+
+Every worker gets its own named Channel, so a command sent to one worker can
+only be read by that worker. The GUI sends to one channel or broadcasts to
+all of them, and workers reply on a single queue the GUI drains.
+
+    bus = MessageBus()
+    ild = bus.channel('ild')                  # hand this to the worker
+    bus.send('ild', 'stop')
+    msg = ild.recv(timeout=0.05)              # in the worker, None on timeout
+    ild.reply('status', running=False)
+    for msg in bus.replies(): ...             # in the GUI loop
+
+The queues are multiprocessing Queues, so channels also work for workers
+started as processes, as long as they are passed in when the process starts.
+"""
+import queue
+import multiprocessing
+from collections import namedtuple
+
+Message = namedtuple('Message', 'sender command args')
+
+
+class Channel:
+    """One worker's end of the bus."""
+
+    def __init__(self, name, inbox, outbox):
+        self.name = name
+        self._inbox = inbox
+        self._outbox = outbox
+
+    def recv(self, timeout=None):
+        """Next Message for this worker, or None if none came within timeout s."""
+        try:
+            return self._inbox.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def poll(self):
+        """Next Message if one is already waiting, otherwise None."""
+        try:
+            return self._inbox.get_nowait()
+        except queue.Empty:
+            return None
+
+    def reply(self, command, **args):
+        """Send a status or report back to the GUI."""
+        self._outbox.put(Message(self.name, command, args))
+
+
+class MessageBus:
+    """Named command channels to the workers and one reply queue back."""
+
+    def __init__(self):
+        self._inboxes = {}
+        self._replies = multiprocessing.Queue()
+
+    def channel(self, name):
+        """Channel for worker `name`, made on first use."""
+        if name not in self._inboxes:
+            self._inboxes[name] = multiprocessing.Queue()
+        return Channel(name, self._inboxes[name], self._replies)
+
+    def names(self):
+        return list(self._inboxes)
+
+    def send(self, name, command, **args):
+        """Send a command to one worker. Unknown names raise KeyError."""
+        self._inboxes[name].put(Message('gui', command, args))
+
+    def broadcast(self, command, **args):
+        """Send a command to every worker."""
+        for name in self._inboxes:
+            self.send(name, command, **args)
+
+    def remove(self, name):
+        """Forget a worker that has finished. Anything still queued for it is dropped."""
+        self._inboxes.pop(name, None)
+
+    def replies(self, timeout=0):
+        """Yield the replies waiting from the workers, waiting up to timeout s for the first."""
+        try:
+            msg = self._replies.get(timeout=timeout) if timeout else self._replies.get_nowait()
+        except queue.Empty:
+            return
+        yield msg
+        while True:
+            try:
+                yield self._replies.get_nowait()
+            except queue.Empty:
+                return
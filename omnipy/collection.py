@@ -1,8 +1,22 @@
 import time
-from datetime import datetime
+import os
+import json
+import threading
+from collections import deque
+import numpy as np
 
 
-def PSU_run(dbSync,DC,instrument ,Inital_voltage_limit, Inital_current_limit, Overcurrent_protection, controlQue, reportQue):
+def PSU_run(dbSync,DC,instrument ,Inital_voltage_limit, Inital_current_limit, Overcurrent_protection, channel, telemetry_period=2, status_period=1):
+    """Supervise one PSU until told to stop or it trips too often.
+
+    Blocks on its bus.Channel between polls instead of spinning. Every
+    telemetry_period V, I and the output state are read in one poll cycle
+    and logged; in between, the output state alone is checked every
+    status_period to catch OCP trips.
+
+    Commands: 'set_V' and 'set_I' with value=..., 'status' and 'stop'.
+    Replies: 'status', 'fault' and 'terminal_fault'.
+    """
     err = 0
     DC.SetOutputState(instrument, state='Off')
     
@@ -14,140 +28,244 @@ def PSU_run(dbSync,DC,instrument ,Inital_voltage_limit, Inital_current_limit, Ov
     DC.SetOverCurrentProtection(instrument, Overcurrent_protection)
     DC.SetOutputState(instrument, state='On')
     
-    start_time2 = time.time()
+    next_telemetry = time.time() + telemetry_period
+    next_status = time.time() + status_period
     
     print('psu control loop confirm')
     while True:
-        if controlQue.empty():
-            if time.time() - start_time2 > 2:
-                V = DC.Vget(instrument)
-                I = DC.Iget(instrument)
-                dbSync.db_write(instrument,'V',V)
-                dbSync.db_write(instrument,'I',I)
-                start_time2 = time.time()
-                print(V,I, err)
-
-            if DC.GetOutputState(instrument) == 'Off':
-                # print('OCP Trip')
-                err += 1
-                reportQue.put(instrument+' FAULT NO.'+str(err))
-                time.sleep(1)
-                    
-            if err >2:
-                DC.SetOutputState(instrument, state='Off')
-                return reportQue.put(instrument+' TERMINAL FAULT')
-            
-    
-        else:
-            command = controlQue.get()
-            if 'new_V' in command:
-                DC.Vset(command['new_V'], instrument)
-            elif 'new_I' in command:
-                DC.Vset(command['new_I'], instrument)
-            elif 'stop' in command:
+        msg = channel.recv(timeout=max(min(next_telemetry, next_status) - time.time(), 0))
+
+        if msg is not None:
+            if msg.command == 'set_V':
+                DC.Vset(msg.args['value'], instrument)
+            elif msg.command == 'set_I':
+                DC.Iset(msg.args['value'], instrument)
+            elif msg.command == 'status':
+                channel.reply('status', instrument=instrument, faults=err)
+            elif msg.command == 'stop':
                 DC.SetOutputState(instrument, state='Off')
                 print('PSU log stopping')
                 break
             else:
-                print(controlQue.get())
+                print(msg)
+
+        now = time.time()
+        if now >= next_telemetry:
+            V, I, state = DC.Telemetry(instrument)
+            dbSync.db_write(instrument,'V',V)
+            dbSync.db_write(instrument,'I',I)
+            print(V,I, err)
+            next_telemetry += telemetry_period
+            if next_telemetry < now:  # fell behind, keep the period rather than catching up
+                next_telemetry = now + telemetry_period
+        elif now >= next_status:
+            state = DC.GetOutputState(instrument)
+        else:
+            continue
+        next_status = now + status_period
+
+        if state == 'Off':
+            # print('OCP Trip')
+            err += 1
+            channel.reply('fault', text=instrument+' FAULT NO.'+str(err))
+                
+        if err >2:
+            DC.SetOutputState(instrument, state='Off')
+            return channel.reply('terminal_fault', text=instrument+' TERMINAL FAULT')
         
     return True
 
-def VoltLog(dbSync,unit, ax, fig_agg2, controlQue):
-
-    data = [[],[]]
-    t = []
-    
+def VoltLog(dbSync,unit, live, channel):
+    """Stream the ADC24 into a utils.LivePlot and log to the database every 2 s."""
     channels= [1,3]
     ranges = ['HRDL_78_MV','HRDL_78_MV']
     conversion_times = ['HRDL_100MS','HRDL_100MS']
     
     unit.setup_channels(channels,ranges, conversion_times)    #Setup Channel
+    unit.start_stream()
+    last_write = time.time()
 
     while True:
-
-        i = 0
-        raw = unit.getV()
-        x = 0
-        for val in raw:
-            data[x].append(val)
-            x += 1
-        now = datetime.now()
-        t_ = now.strftime("%H:%M:%S:%f")
-        t.append(t_)
-        
-        ax.cla()
-        if len(t) > 199:
-            t = t[1:201]
-            x = 0
-            while x < len(channels):
-                data[x] = data[x][1:201]
-                x += 1
-        for dat in data:
-            ax.plot(t,dat,  color='purple')
-        ax.grid()
+        msg = channel.recv(timeout=0.5)
+        if msg is not None and msg.command == 'stop':
+            print('Vlog Stop')
+            unit.close()
+            break
+        t, V = unit.read()
+        if len(t) == 0:
+            continue
+        for x in range(len(channels)):
+            live.append(x, t, V[:, x])
         
-        pos = 0
-        if i > 19:
-            for dat in data:  
+        if time.time() - last_write > 2:
+            for pos in range(len(channels)):
                 try:
-                    dbSync.db_write('Temp', 'Sens '+str(pos), dat[-1])
+                    dbSync.db_write('Temp', 'Sens '+str(pos), V[-1, pos])
                 except:
                     print('server connection Issue')
-                pos +=1
-            i=0
-            
-        #print(data[0])
-        #print(t)
-        if len(t) <25:
-            ax.set(xticks=[t[0],t[-1]])
-            #print(t[0],t[-1])
-        elif len(t) <175:
-            middleIndex = int(len(t)/2)
-            ax.set(xticks=[t[0],t[middleIndex],t[-1]])
-            #print(t[0],t[middleIndex],t[-1])
-        else :
-        #len(t) <198:
-            middleIndex = int(len(t)/2)
-            bottomIndex = int(len(t[0:middleIndex])/2)
-            ax.set(xticks=[t[0],t[bottomIndex],t[middleIndex],t[bottomIndex+middleIndex],t[-1]])
-                            
-        fig_agg2.draw()
-        
-        if not controlQue.empty():
-            if 'stop' in controlQue.get():
-                print('Vlog Stop')
-                unit.close()
-                break
+            last_write = time.time()
 
 
-def PollDis(disp_sensor, ax, fig_agg1, controlQue):
+def PollDis(disp_sensor, live, channel, period=0.05):
+    """Poll the ILD into a utils.LivePlot every `period` s."""
     print('Poll Start')
-    t = []
-    data = []
     while True:
-        data_raw, t_raw = disp_sensor.poll()
-        data.append(data_raw), t.append(t_raw)
-        if len(t) > 100:
-            t = t[1:102]
-            data =data[1:102]
-        ax.cla()                    # clear the subplot
-        ax.grid()                   # draw the grid
-        ax.plot(t,data,  color='purple')
-        
-        if len(t) <20:
-            ax.set(xticks=[t[0],t[-1]])
-            #print(t[0],t[-1])
-        elif len(t) <80:
-            middleIndex = int(len(t)/2)
-            ax.set(xticks=[t[0],t[middleIndex],t[-1]])
-        else :
-            middleIndex = int(len(t)/2)
-            bottomIndex = int(len(t[0:middleIndex])/2)
-            ax.set(xticks=[t[0],t[bottomIndex],t[middleIndex],t[bottomIndex+middleIndex],t[-1]])
-        fig_agg1.draw()
-        time.sleep(0.05)
-        if not controlQue.empty() :
-            if 'stop' in controlQue.get():
-                print('Poll Stop')
-                break
\ No newline at end of file
+        value, _ = disp_sensor.poll()
+        live.append(0, time.time(), value)
+        msg = channel.recv(timeout=period)
+        if msg is not None and msg.command == 'stop':
+            print('Poll Stop')
+            break
+
+class ILDStreamRecorder:
+    """Continuously drain the ILD buffer into an append-only binary file.
+
+    Samples are appended to <filename>.bin as little-endian float64. Camera
+    and ignition events are appended to <filename>.markers.csv as the sample
+    index they happened at, so any shot window can be cut out of the file and
+    re-analysed later. The most recent samples are also kept in memory and
+    returned by block_data(), so the recorder can stand in for the sensor in
+    analysis.Raw_Data_Collection.
+    """
+
+    dtype = np.dtype('<f8')
+
+    def __init__(self, disp_sensor, filename, freqLaser=2000, tail_seconds=10, period=0.05):
+        self.disp_sensor = disp_sensor
+        self.freq = freqLaser
+        self.period = period
+        self.data_file = filename + '.bin'
+        self.marker_file = filename + '.markers.csv'
+        self.samples = 0
+        self._tail = np.zeros(int(tail_seconds*freqLaser), dtype=self.dtype)
+        self._offsets = deque(maxlen=20)
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.listeners = []  # called as listener(chunk, first) for each drained chunk
+
+        self._data = open(self.data_file, 'ab')
+        new_markers = not os.path.isfile(self.marker_file)
+        self._markers = open(self.marker_file, 'a')
+        if new_markers:
+            meta = {'timestamp': time.time(), 'rate': freqLaser, 'dtype': self.dtype.str,
+                    'data_file': os.path.basename(self.data_file)}
+            self._markers.write(json.dumps(meta) + '\n')
+            self._markers.write('sample,time,label,value\n')
+        else:
+            # Appending to an old recording, carry on counting where it stopped
+            self.samples = os.path.getsize(self.data_file)//self.dtype.itemsize
+        self._markers.flush()
+
+        self.disp_sensor.block_data()  # discard whatever built up before recording
+        self._thread = threading.Thread(target=self._run, name='ILD stream', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopping:
+            self.drain()
+            time.sleep(self.period)
+        self.drain()
+
+    def drain(self):
+        """Move everything in the sensor buffer to disk and the tail buffer."""
+        chunk = np.asarray(self.disp_sensor.block_data(), dtype=self.dtype)
+        now = time.time()
+        with self._lock:
+            if chunk.size:
+                chunk.tofile(self._data)
+                self._data.flush()
+                n = min(chunk.size, self._tail.size)
+                self._tail = np.roll(self._tail, -n)
+                self._tail[-n:] = chunk[-n:]
+                self.samples += chunk.size
+            first = self.samples - chunk.size
+            # The newest sample arrived no later than now. Transfer latency only
+            # ever makes it look later, so the smallest recent offset is best.
+            self._offsets.append(now - self.samples/self.freq)
+        if chunk.size:
+            for listener in self.listeners:
+                try:
+                    listener(chunk, first)
+                except Exception as e:  # a broken listener must not stop the recording
+                    print('ILD stream listener %r failed: %r' % (listener, e))
+        return chunk.size
+
+    def sample_at(self, t=None):
+        """Convert a time.time() value (default now) to a sample index."""
+        if t is None:
+            t = time.time()
+        with self._lock:
+            if not self._offsets:
+                return self.samples
+            return int(round((t - min(self._offsets))*self.freq))
+
+    def mark(self, label, value='', t=None):
+        """Record an event such as 'cam' or 'ign' in the stream time base."""
+        sample = self.sample_at(t)
+        with self._lock:
+            self._markers.write('%d,%.6f,%s,%s\n' % (sample, sample/self.freq, label, value))
+            self._markers.flush()
+        return sample
+
+    def block_data(self, N=None):
+        """Return the last N samples held in memory (all of them by default)."""
+        with self._lock:
+            if N is None:
+                N = min(self.samples, self._tail.size)
+            return self._tail[self._tail.size-N:].copy()
+
+    def samples_between(self, first, stop):
+        """Samples first to stop (stream indices), from memory if still held,
+        otherwise read back from the .bin file."""
+        with self._lock:
+            start = self.samples - self._tail.size
+            if first < 0 or stop > self.samples:
+                raise ValueError('Samples %d to %d have not been recorded' % (first, stop))
+            if first >= start:
+                return self._tail[first-start:stop-start].copy()
+        # every drained chunk is flushed, so the file has everything up to self.samples
+        return np.fromfile(self.data_file, dtype=self.dtype, count=stop - first,
+                           offset=first*self.dtype.itemsize)
+
+    def stop(self):
+        if self._stopping:
+            return
+        self._stopping = True
+        self._thread.join()
+        self._data.close()
+        self._markers.close()
+
+
+def load_stream(filename):
+    """Open a recording made by ILDStreamRecorder.
+
+    Returns (data, meta, markers): data is a read-only memmap of the samples,
+    meta the header dict and markers a list of (sample, label, value) tuples.
+    """
+    base = filename[:-4] if filename.endswith('.bin') else filename
+    with open(base + '.markers.csv', 'r') as f:
+        meta = json.loads(f.readline())
+        f.readline()
+        markers = []
+        for line in f:
+            sample, _, label, value = line.rstrip('\n').split(',', 3)
+            markers.append((int(sample), label, value))
+    data_file = os.path.join(os.path.dirname(base), meta['data_file'])
+    if os.path.getsize(data_file) == 0:
+        data = np.zeros(0, dtype=meta['dtype'])
+    else:
+        data = np.memmap(data_file, dtype=meta['dtype'], mode='r')
+    return data, meta, markers
+
+
+def stream_window(data, rate, sample, start, stop):
+    """Cut out samples from `start` to `stop` seconds relative to `sample`.
+
+    Returns (t, y) with t in seconds relative to the marker. The window is
+    clipped to the data that was actually recorded.
+    """
+    i0 = max(sample + int(round(start*rate)), 0)
+    i1 = min(sample + int(round(stop*rate)), len(data))
+    y = np.array(data[i0:i1])
+    t = (np.arange(i0, i1) - sample)/rate
+    return t, y
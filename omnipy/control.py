@@ -1,12 +1,16 @@
 
 
 import ctypes
+import time
+import threading
+import numpy as np
 from picosdk.picohrdl import picohrdl as hrdl
 from picosdk.functions import assert_pico2000_ok
 import pyvisa
 from datetime import datetime
 
 from RazorBill.instruments.micro_epsilon import MEDAQLib
+from RazorBill.instruments.tenma import DC_7227xx
 import serial
 from pyfirmata import Arduino, util
 from pyfirmata.util import Iterator
@@ -14,6 +18,10 @@ from pyfirmata.util import Iterator
 global event
 
         
+HRDL_BM_STREAM = 2   # HRDL_BLOCK_METHOD from picohrdl.h, not exported by picosdk
+HRDL_CONVERSION_MS = [60, 100, 180, 340, 660]   # by HRDL_CONVERSIONTIME value
+
+
 class ADC24:
     
     def __init__(self):
@@ -31,8 +39,16 @@ class ADC24:
         
         self.range = [0]*16
         self.conversion_time = [0]*16
+        self.Vmax = [0]*16
+        self.max_count = [0]*16
+        
+        self.streaming = False
+        self._stream_thread = None
+        self._stream_lock = threading.Lock()
+        self._stream_chunks = []
 
     def close(self):
+        self.stop_stream()
         self.status["closeUnit"] = hrdl.HRDLCloseUnit(self.chandle)
         assert_pico2000_ok(self.status["closeUnit"])
 
@@ -43,14 +59,14 @@ class ADC24:
             try:
                 print(channels[x])
                 self.range[x] = hrdl.HRDL_VOLTAGERANGE[channel_range[x]]
-                self.Vmax = 2500/(2**self.range[x])
+                self.Vmax[x] = 2500/(2**self.range[x])
                 min_count = ctypes.c_int32()
                 max_count = ctypes.c_int32()
                 self.status['ADCCounts'] = hrdl.HRDLGetMinMaxAdcCounts(self.chandle, ctypes.byref(min_count), ctypes.byref(max_count), channels[x])
-                self.max_count = max_count.value
+                self.max_count[x] = max_count.value
                 self.conversion_time[x] = hrdl.HRDL_CONVERSIONTIME[channel_conversion_time[x]]
                 x += 1
-                print(self.max_count)
+                print(self.max_count[x-1])
             except Exception as Arguments:
                 return Arguments
 
@@ -61,88 +77,142 @@ class ADC24:
             overflow = ctypes.c_int16(0)
             value = ctypes.c_int32()
             self.status["getSingleValue"] = hrdl.HRDLGetSingleValue(self.chandle, self.channels[x], self.range[x], self.conversion_time[x], 0, ctypes.byref(overflow), ctypes.byref(value))
-            data.append((value.value/self.max_count)*self.Vmax)
+            data.append((value.value/self.max_count[x])*self.Vmax[x])
             x +=1
         return data
 
+    def start_stream(self, interval_ms=None, buffer_size=100):
+        """Sample every channel from setup_channels continuously.
+
+        The unit converts the enabled channels one after another, so the
+        shortest interval is the conversion time times the number of
+        channels, which is also the default. A background thread collects
+        the driver buffer into numpy arrays; fetch them with read().
+        """
+        n = len(self.channels)
+        for x in range(n):
+            self.status["setChannel"] = hrdl.HRDLSetAnalogInChannel(self.chandle, self.channels[x], 1, self.range[x], 0)
+            assert_pico2000_ok(self.status["setChannel"])
+        if interval_ms is None:
+            interval_ms = HRDL_CONVERSION_MS[self.conversion_time[0]]*n
+        self.status["setInterval"] = hrdl.HRDLSetInterval(self.chandle, int(interval_ms), self.conversion_time[0])
+        assert_pico2000_ok(self.status["setInterval"])
+        
+        self._scale = np.array(self.Vmax[:n])/np.array(self.max_count[:n])
+        self._times = (ctypes.c_int32*buffer_size)()
+        self._values = (ctypes.c_int32*(buffer_size*n))()
+        self._buffer_size = buffer_size
+        self._poll = min(interval_ms/1000*max(buffer_size//4, 1), 0.5)
+        
+        self.status["run"] = hrdl.HRDLRun(self.chandle, buffer_size, HRDL_BM_STREAM)
+        assert_pico2000_ok(self.status["run"])
+        self._stream_start = time.time()
+        self.streaming = True
+        self._stream_thread = threading.Thread(target=self._stream, daemon=True)
+        self._stream_thread.start()
+
+    def _stream(self):
+        n = len(self.channels)
+        overflow = ctypes.c_int16(0)
+        while self.streaming:
+            time.sleep(self._poll)
+            got = hrdl.HRDLGetTimesAndValues(self.chandle, ctypes.byref(self._times), ctypes.byref(self._values), ctypes.byref(overflow), self._buffer_size)
+            if got <= 0:
+                continue
+            t = self._stream_start + np.frombuffer(self._times, np.int32, got)/1000
+            V = np.frombuffer(self._values, np.int32, got*n).reshape(got, n)*self._scale
+            with self._stream_lock:
+                self._stream_chunks.append((t, V))
+
+    def read(self):
+        """Samples collected since the last call, as (t, V).
+
+        t holds wall-clock times in s and V is shaped (samples, channels) in mV.
+        """
+        with self._stream_lock:
+            chunks, self._stream_chunks = self._stream_chunks, []
+        if not chunks:
+            return np.empty(0), np.empty((0, len(self.channels)))
+        t, V = zip(*chunks)
+        return np.concatenate(t), np.concatenate(V)
+
+    def stop_stream(self):
+        if not self.streaming:
+            return
+        self.streaming = False
+        self._stream_thread.join()
+        hrdl.HRDLStop(self.chandle)
+
 class DC_PSU:
+    """Front end for any number of Tenma supplies, addressed by VISA name.
+
+    Each supply is a RazorBill DC_7227xx, which is a multiton: the first call
+    for a port opens a session that is then kept, and every supply has its
+    own lock so two PSUs can be polled from different threads at once.
+    Drivers are kept per port, as looking up the multiton makes a VISA
+    resource manager query every time.
+    """
     
     def __init__(self):
         self.rm = pyvisa.ResourceManager()
-        self.state = {b'S\n':'On',b's\n':'On',b'r/n':'On', b'\x12\n':'Off'
-                      , b'2\n':'Off'}
         self.OUT = True
+        self._supplies = {}
+    
+    def supply(self, instrument):
+        psu = self._supplies.get(instrument)
+        if psu is None:
+            psu = self._supplies[instrument] = DC_7227xx(instrument)
+        return psu
     
     def Iget(self, instrument):
-        connection = self.rm.open_resource(instrument)
-        DC_IOUT = (float(connection.query('IOUT1?')))
-        connection.close()
-        return DC_IOUT
+        return self.supply(instrument).current_actual
     
     def Vget(self, instrument):
-        connection = self.rm.open_resource(instrument)
-        DC_VOUT = (float(connection.query('VOUT1?')))
-        connection.close()
-        return DC_VOUT
+        return self.supply(instrument).voltage_actual
         
     def Iset(self, value, instrument):
-        connection = self.rm.open_resource(instrument)
-        command = 'ISET1:'+str(value)
-        # print(command)
-        connection.write(command)
-        connection.close()
+        self.supply(instrument).current_limit = value
         return
     
     def Vset(self, value, instrument):
-        connection = self.rm.open_resource(instrument)
-        command = 'VSET1:'+str(value)
-        # print(command)
-        connection.write(command)
-        connection.close()
+        self.supply(instrument).voltage_limit = value
         return
     
     def SetOutputState(self, instrument, **kwags:"state"):
-        connection = self.rm.open_resource(instrument)
+        psu = self.supply(instrument)
         # print(kwags)
         if kwags == {'state':'On'}:
-            connection.write('OUT1')
+            psu.output_enable = True
             self.OUT = False
             print('supply Turned on')
         elif kwags == {'state':'Off'}:
-            connection.write('OUT0')
+            psu.output_enable = False
             self.OUT = True
         else:
             print('supply toggling')
             if self.OUT:
                 self.OUT = False
-                connection.write('OUT0')
+                psu.output_enable = False
             else:
                 self.OUT = True
-                connection.write('OUT1')
+                psu.output_enable = True
         
         return self.OUT
     
+    def Telemetry(self, instrument):
+        """V, I and output state read together under the supply's lock"""
+        V, I, status = self.supply(instrument).telemetry
+        return V, I, 'On' if status['output'] else 'Off'
+    
     def SetOverCurrentProtection(self, instrument, state):
-        connection = self.rm.open_resource(instrument)
-        connection.write('OCP'+str(state))
-        connection.close()
+        self.supply(instrument).ocp_enable = state
         
     
     def GetOutputState(self, instrument):
-        connection = self.rm.open_resource(instrument)
-        connection.write('STATUS?')
-        responce = connection.read_raw()
-        # print(self.state[responce])
-        try:
-            return self.state[responce]
-        except:
-            return responce
+        return 'On' if self.supply(instrument).status['output'] else 'Off'
     
     def identify(self, instrument):
-        connection = self.rm.open_resource(instrument)
-        connection.write('*IDN?')
-        responce = connection.read_raw()
-        return responce
+        return self.supply(instrument).raw_query('*IDN?')
     
     def list_available(self):
         return self.rm.list_resources()
@@ -0,0 +1,99 @@
+"""
+Re-run the Ibit analysis over every shot in a directory of ILD stream
+recordings (see collection.ILDStreamRecorder), e.g. after changing the fit
+windows or the pendulum constants.
+
+    python -m omnipy.reanalyse "D:/Data/PFT" -o results.csv --mp 5e-6 --L 0.1
+
+Shots are found from the ignition markers and spread over a
+ProcessPoolExecutor. The results table has one row per shot.
+"""
+import os
+import io
+import csv
+import glob
+import time
+import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from omnipy import analysis, collection
+
+COLUMNS = ['file', 'shot', 'sample', 'voltage', 'frequency', 'frequency_err', 'B', 'Ibit',
+           'residual_before', 'residual_after', 'error']
+
+_streams = {}  # recordings already opened by this worker process
+
+
+def find_shots(directory, label='ign'):
+    """List (filename, shot number, sample, voltage) for every marked shot."""
+    shots = []
+    for markers in sorted(glob.glob(os.path.join(directory, '*.markers.csv'))):
+        filename = markers[:-len('.markers.csv')]
+        data, meta, marks = collection.load_stream(filename)
+        n = 0
+        for sample, mark, value in marks:
+            if mark == label:
+                n += 1
+                shots.append((filename, n, sample, value))
+    return shots
+
+
+def analyse(task):
+    """Analyse one shot. Runs in a worker process, so it only takes picklable arguments."""
+    (filename, shot, sample, voltage), (step, mp, L, windows) = task
+    row = {'file': os.path.basename(filename), 'shot': shot, 'sample': sample, 'voltage': voltage}
+    try:
+        if filename not in _streams:
+            _streams[filename] = collection.load_stream(filename)
+        data, meta, _ = _streams[filename]
+        t, y = collection.stream_window(data, meta['rate'], sample, -step/2, step/2)
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = analysis.analyse_shot(t, y - y.mean(), meta['rate'], mp=mp, L=L, windows=windows)
+        row.update(frequency=result.frequency, frequency_err=result.frequency_err, B=result.B,
+                   Ibit=result.bit, residual_before=result.residuals[0],
+                   residual_after=result.residuals[1])
+    except Exception as e:
+        row['error'] = repr(e)
+    return row
+
+
+def reanalyse(directory, output, step=6, mp=5e-6, L=0.1, windows=(-3, -0.2, 0.2, 3),
+              workers=None, chunksize=8, label='ign'):
+    """Analyse every shot in `directory` in parallel and write a CSV to `output`.
+
+    Returns the number of shots and the throughput in shots per second.
+    """
+    start = time.perf_counter()
+    shots = find_shots(directory, label)
+    params = (step, mp, L, tuple(windows))
+    with open(output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for row in pool.map(analyse, [(shot, params) for shot in shots], chunksize=chunksize):
+                writer.writerow(row)
+    elapsed = time.perf_counter() - start
+    rate = len(shots)/elapsed if elapsed else 0
+    print('%d shots in %0.2f s (%0.1f shots/s)' % (len(shots), elapsed, rate))
+    return len(shots), rate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('directory', help='directory of ILD stream recordings')
+    parser.add_argument('-o', '--output', default='reanalysis.csv')
+    parser.add_argument('--step', type=float, default=6, help='seconds of trace per shot, centred on the marker')
+    parser.add_argument('--mp', type=float, default=5e-6, help='pendulum mass, as in Raw_Data_Collection')
+    parser.add_argument('--L', type=float, default=0.1, help='pendulum length, as in Raw_Data_Collection')
+    parser.add_argument('--windows', type=float, nargs=4, default=(-3, -0.2, 0.2, 3),
+                        metavar=('START1', 'STOP1', 'START2', 'STOP2'), help='fit windows, s from the marker')
+    parser.add_argument('--workers', type=int, default=None, help='processes, default one per CPU')
+    parser.add_argument('--chunksize', type=int, default=8, help='shots sent to a worker at a time')
+    parser.add_argument('--label', default='ign', help='marker label that starts a shot')
+    args = parser.parse_args(argv)
+    reanalyse(args.directory, args.output, args.step, args.mp, args.L, args.windows,
+              args.workers, args.chunksize, args.label)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Voltage sweep plans for the ignition test, with progress kept on disk.
+
+A plan is a list of Step(voltage, shots). V-Fix is a single step and V-Sweep
+one step per voltage. Sweep walks through the plan one shot at a time:
+
+    sweep = Sweep(sweep_plan(1500, 2000, 100, 10), 'sweep_progress.json')
+    for index, step, shot in sweep.shots():
+        ...fire a shot at step.voltage...
+        sweep.record(voltage=measured)
+
+Progress and per-step statistics are written to the JSON file after every
+recorded shot, so if the software stops part way the same plan picks up
+from the next shot.
+"""
+import os
+import json
+import time
+from collections import namedtuple
+
+Step = namedtuple('Step', 'voltage shots')
+
+
+def fixed_plan(voltage, shots):
+    return [Step(voltage, shots)]
+
+
+def sweep_plan(start, stop, step, shots):
+    """One Step per voltage from start to stop inclusive, `shots` shots each."""
+    if step == 0 or start == stop:
+        return fixed_plan(start, shots)
+    step = abs(step) if stop > start else -abs(step)
+    n = int((stop - start)/step + 1e-9) + 1
+    return [Step(start + i*step, shots) for i in range(n)]
+
+
+class Sweep:
+    """Runs a plan shot by shot, saving progress to `progress_file`.
+
+    If the file holds the same plan and it is not finished, the sweep
+    resumes from it, otherwise it starts again from the first step.
+    stats has one dict per step with the shots done, the time spent on the
+    step and the shot rate.
+    """
+
+    def __init__(self, plan, progress_file='sweep_progress.json', resume=True):
+        self.plan = [Step(*s) for s in plan]
+        self.progress_file = progress_file
+        self.step = 0
+        self.stats = [{'voltage': s.voltage, 'shots': s.shots, 'done': 0, 'started': None,
+                       'elapsed': 0.0, 'rate': 0.0, 'last': None} for s in self.plan]
+        self.resumed = resume and self._load()
+        self._t_last = None
+
+    def _load(self):
+        try:
+            with open(self.progress_file) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if [Step(*s) for s in saved['plan']] != self.plan or saved['step'] >= len(self.plan):
+            return False
+        self.step = saved['step']
+        self.stats = saved['stats']
+        return True
+
+    def save(self):
+        # write then rename, so a crash mid-write never leaves a broken file
+        tmp = self.progress_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'plan': self.plan, 'step': self.step, 'stats': self.stats,
+                       'saved': time.time()}, f, indent=1)
+        os.replace(tmp, self.progress_file)
+
+    @property
+    def finished(self):
+        return self.step >= len(self.plan)
+
+    @property
+    def shots_done(self):
+        return sum(s['done'] for s in self.stats)
+
+    @property
+    def shots_total(self):
+        return sum(s.shots for s in self.plan)
+
+    def shots(self):
+        """Yield (step index, Step, shot number within the step) for every shot left.
+
+        Call record() after each shot is fired; a shot that is not recorded
+        is yielded again.
+        """
+        while not self.finished:
+            step = self.plan[self.step]
+            stats = self.stats[self.step]
+            if stats['done'] >= step.shots:
+                self.step += 1
+                self._t_last = None
+                self.save()
+                continue
+            if stats['started'] is None:
+                stats['started'] = time.time()
+            if self._t_last is None:
+                self._t_last = time.time()
+            yield self.step, step, stats['done'] + 1
+
+    def record(self, **info):
+        """Count a shot on the current step. info is kept as the step's 'last' shot."""
+        now = time.time()
+        stats = self.stats[self.step]
+        stats['done'] += 1
+        stats['elapsed'] += now - (self._t_last or now)
+        stats['rate'] = stats['done']/stats['elapsed'] if stats['elapsed'] else 0.0
+        stats['last'] = dict(info, time=now)
+        self._t_last = now
+        self.save()
+
+    def summary(self):
+        lines = []
+        for s in self.stats:
+            lines.append('%6g V  %d/%d shots  %0.1f s  %0.3f shots/s' % (
+                s['voltage'], s['done'], s['shots'], s['elapsed'], s['rate']))
+        return '\n'.join(lines)
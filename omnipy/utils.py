@@ -2,11 +2,16 @@ import PySimpleGUI as sg
 from PIL import Image, ImageTk
 import io
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from influxdb_client import Point
+from influxdb_client import Point, WritePrecision
 import matplotlib.pyplot as plt
 import influxdb_client
 from influxdb_client.client.write_api import SYNCHRONOUS
 from datetime import datetime
+import os
+import time
+import queue
+import threading
+import numpy as np
 
 
 def LEDIndicator(key=None, radius=30):
@@ -64,13 +69,230 @@ class figure_tools:
             disp.update(value = txt)
 
 
+def minmax_decimate(x, y, n_bins, log=False):
+    """Cut a trace down to the min and max of at most n_bins bins.
+
+    With n_bins set to the axes width in pixels the plot looks the same as
+    drawing every point. log=True spaces the bins evenly in log(x) for
+    semilog axes, and drops x <= 0.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if log:
+        keep = x > 0
+        x, y = x[keep], y[keep]
+    if len(y) <= 2*n_bins:
+        return x, y
+    if log:
+        edges = np.unique(np.geomspace(1, len(y) + 1, n_bins + 1).astype(int) - 1)[:-1]
+    else:
+        edges = np.linspace(0, len(y), n_bins, endpoint=False).astype(int)
+    xd = np.repeat(x[edges], 2)
+    yd = np.empty(2*len(edges))
+    yd[0::2] = np.minimum.reduceat(y, edges)
+    yd[1::2] = np.maximum.reduceat(y, edges)
+    return xd, yd
+
+
+class RingBuffer:
+    """Fixed-size numpy FIFO, the oldest values are overwritten once full."""
+
+    def __init__(self, size, dtype=float):
+        self.size = size
+        self.data = np.zeros(size, dtype)
+        self.count = 0  # values ever written
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def extend(self, values):
+        values = np.asarray(values, self.data.dtype).ravel()
+        n_in = len(values)
+        values = values[-self.size:]
+        n = len(values)
+        start = (self.count + n_in - n) % self.size
+        first = min(n, self.size - start)
+        self.data[start:start+first] = values[:first]
+        self.data[:n-first] = values[first:]
+        self.count += n_in
+
+    def view(self):
+        """The held values, oldest first, as a new array."""
+        if self.count <= self.size:
+            return self.data[:self.count].copy()
+        start = self.count % self.size
+        return np.concatenate((self.data[start:], self.data[:start]))
+
+
+class LivePlot:
+    """Scrolling plot of one or more traces fed from a worker thread.
+
+    Workers call append(), which only copies into a RingBuffer per trace.
+    The GUI thread calls refresh() as often as it likes; at most max_fps
+    times a second it moves the persistent Line2D artists to the new data
+    and blits just the lines over a cached background. The axes are only
+    fully redrawn when the data runs off the current limits, and then they
+    jump by a quarter of the width rather than scrolling every sample.
+    Times are plotted in s from the first sample appended.
+    """
+
+    def __init__(self, canvas, ax, labels, size=1000, max_fps=10, span=None):
+        self.canvas = canvas
+        self.ax = ax
+        self.span = span
+        self.min_interval = 1/max_fps
+        self.t = [RingBuffer(size) for _ in labels]
+        self.y = [RingBuffer(size) for _ in labels]
+        self.lines = [ax.plot([], [], label=label, animated=True)[0] for label in labels]
+        self.legend = ax.legend(loc='upper left') if len(labels) > 1 else None
+        self.t0 = None
+        self.draw_time = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_draw = 0
+        self._background = None
+        self._cid = canvas.mpl_connect('draw_event', self._on_draw)
+
+    def append(self, trace, t, y):
+        """Add samples (scalars or arrays) to trace number `trace`."""
+        t = np.atleast_1d(np.asarray(t, float))
+        if len(t) == 0:
+            return
+        with self._lock:
+            if self.t0 is None:
+                self.t0 = t[0]
+            self.t[trace].extend(t - self.t0)
+            self.y[trace].extend(y)
+            self._dirty = True
+
+    def refresh(self, force=False):
+        """Redraw if there is new data and the rate cap allows. Call from the GUI thread."""
+        start = time.perf_counter()
+        if not self._dirty or (start - self._last_draw < self.min_interval and not force):
+            return False
+        with self._lock:
+            data = [(t.view(), y.view()) for t, y in zip(self.t, self.y)]
+            self._dirty = False
+        for line, (t, y) in zip(self.lines, data):
+            line.set_data(t, y)
+        if self._rescale(data) or self._background is None:
+            self.canvas.draw()  # _on_draw recaches the background and blits the lines
+        else:
+            self.canvas.restore_region(self._background)
+            self._draw_lines()
+        self._last_draw = time.perf_counter()
+        self.draw_time = self._last_draw - start
+        return True
+
+    def close(self):
+        """Stop drawing and take the lines off the axes, so another LivePlot can use them."""
+        self.canvas.mpl_disconnect(self._cid)
+        for line in self.lines:
+            line.remove()
+        if self.legend is not None:
+            self.legend.remove()
+        self.canvas.draw_idle()
+
+    def _draw_lines(self):
+        for line in self.lines:
+            self.ax.draw_artist(line)
+        self.canvas.blit(self.ax.bbox)
+
+    def _on_draw(self, event):
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self._draw_lines()
+
+    def _rescale(self, data):
+        data = [(t, y) for t, y in data if len(t)]
+        if not data:
+            return False
+        t_lo = min(t[0] for t, _ in data)
+        t_hi = max(t[-1] for t, _ in data)
+        y_lo = min(np.nanmin(y) for _, y in data)
+        y_hi = max(np.nanmax(y) for _, y in data)
+        changed = False
+        x0, x1 = self.ax.get_xlim()
+        if t_hi > x1 or t_hi < x0:
+            width = self.span or max(t_hi - t_lo, 1)*1.25
+            self.ax.set_xlim(t_hi - 0.75*width, t_hi + 0.25*width)
+            changed = True
+        y0, y1 = self.ax.get_ylim()
+        if y_lo < y0 or y_hi > y1 or (y1 - y0) > 10*(y_hi - y_lo) > 0:
+            pad = 0.1*(y_hi - y_lo) or 1
+            self.ax.set_ylim(y_lo - pad, y_hi + pad)
+            changed = True
+        return changed
+
+
+class ShotRenderer:
+    """Draws analysis.ShotResult objects on the GUI thread.
+
+    The Line2D artists are made once and updated with set_data, and each
+    trace is decimated to the pixel width of its axes before drawing.
+    draw_time is how long the last redraw took, to compare with the
+    result's analysis_time.
+    """
+
+    def __init__(self, canvas, ax, cx):
+        self.canvas = canvas
+        self.ax = ax
+        self.cx = cx
+        self.trace, = ax.plot([], [], 'r-', lw=1, label='raw data')
+        cx.set_xscale('log')
+        self.spectrum, = cx.plot([], [], label='Peak')
+        self.draw_time = 0
+
+    def draw(self, result):
+        start = time.perf_counter()
+        self.trace.set_data(*minmax_decimate(result.t, result.y, int(self.ax.bbox.width)))
+        self.spectrum.set_data(*minmax_decimate(result.freqs, result.spectrum,
+                                                int(self.cx.bbox.width), log=True))
+        self.spectrum.set_label('Peak=%0.2f Hz' % result.frequency)
+        for axis in (self.ax, self.cx):
+            axis.relim()
+            axis.autoscale_view()
+            axis.legend(loc='best')
+        self.canvas.draw()
+        self.draw_time = time.perf_counter() - start
+        return self.draw_time
+
+
 class db_tools:
+    """Writes points to InfluxDB in batches from a background thread.
+
+    db_write only formats the point in line protocol, timestamps it and
+    queues it, so it never waits for the server. The flush thread sends a
+    batch when batch_size lines are waiting or flush_interval seconds have
+    passed. If a write fails, or the queue is full, lines go to the spool
+    file and are replayed once the server accepts writes again.
+
+    queue_depth, last_latency, mean_latency, written and spooled report how
+    the writer is keeping up.
+    """
    
-    def __init__(self, url, token, test_ID):
+    def __init__(self, url, token, test_ID, batch_size=500, flush_interval=1.0, max_queue=10000,
+                 spool='influx_spool.lp', timeout=5000):
         org = "Omnidea Ltd."
-        client = influxdb_client.InfluxDBClient(url=url, token=token, org=org)
+        client = influxdb_client.InfluxDBClient(url=url, token=token, org=org, timeout=timeout)
         self.write_api = client.write_api(write_options=SYNCHRONOUS)
         self.test = test_ID
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool = spool
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.last_latency = 0
+        self.mean_latency = 0
+        self.written = 0
+        self.spooled = 0
+        self._spool_lock = threading.Lock()
+        self._stopping = False
+        self._closing = False  # past the close deadline, spool instead of sending
+        self._thread = threading.Thread(target=self._run, name='db_tools flush', daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
 
     def db_write(self, point, field, data):
         # print(data)
@@ -84,6 +306,132 @@ class db_tools:
               Point(point)
               .field(field, float(data[0]))
             )
-        # print('point created')
-        self.write_api.write(bucket=self.test, org="Omnidea Ltd.", record=point)
-        # print('write Complte')
\ No newline at end of file
+        line = point.time(time.time_ns(), WritePrecision.NS).to_line_protocol()
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            self._to_spool([line])
+
+    def _run(self):
+        while not self._stopping:
+            batch = []
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            if batch:
+                if self._closing:
+                    self._to_spool(batch)
+                elif self._send(batch):
+                    self._replay_spool()
+                else:
+                    self._to_spool(batch)
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _send(self, lines):
+        start = time.perf_counter()
+        try:
+            self.write_api.write(bucket=self.test, org="Omnidea Ltd.", record=lines)
+        except Exception as e:
+            print('server connection Issue', repr(e))
+            return False
+        self.last_latency = time.perf_counter() - start
+        self.mean_latency += (self.last_latency - self.mean_latency)*0.1
+        self.written += len(lines)
+        return True
+
+    def _to_spool(self, lines):
+        with self._spool_lock:
+            with open(self.spool, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+            self.spooled += len(lines)
+
+    def _replay_spool(self):
+        """Send spooled lines now the server is answering. Runs on the flush thread."""
+        with self._spool_lock:
+            if not os.path.isfile(self.spool):
+                return
+            replay = self.spool + '.replay'
+            os.replace(self.spool, replay)  # new failures start a fresh spool
+        with open(replay, 'r') as f:
+            lines = [line.rstrip('\n') for line in f if line.strip()]
+        for i in range(0, len(lines), self.batch_size):
+            if not self._send(lines[i:i+self.batch_size]):
+                self._to_spool(lines[i:])
+                break
+        os.remove(replay)
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far has been written or spooled,
+        or for timeout s. Returns True if the queue emptied."""
+        with self.queue.all_tasks_done:
+            return self.queue.all_tasks_done.wait_for(lambda: not self.queue.unfinished_tasks, timeout)
+
+    def close(self, timeout=10):
+        """Write out the queue, giving up after timeout s. Anything not
+        sent by then goes to the spool for the next session to replay, so
+        an unreachable server doesn't hold up exit."""
+        deadline = time.time() + timeout
+        self.flush(timeout)
+        self._closing = True
+        self._stopping = True
+        self._thread.join(max(deadline - time.time(), 0))
+        left = []
+        while True:
+            try:
+                left.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            self.queue.task_done()
+        if left:
+            self._to_spool(left)
+        # a batch still being sent when time ran out is spooled by the
+        # flush thread if the write fails, as long as the process lives
+
+
+if __name__ == '__main__':
+    # Check the spool and replay against a stand-in InfluxDB:
+    #     python -m omnipy.utils
+    import tempfile
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class StandIn(BaseHTTPRequestHandler):
+        status = 503
+        received = []
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+            if self.status == 204:
+                StandIn.received += body.splitlines()
+            self.send_response(self.status)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    spool = os.path.join(tempfile.mkdtemp(), 'spool.lp')
+    db = db_tools('http://127.0.0.1:%d' % server.server_port, 'token', 'test', batch_size=10,
+                  flush_interval=0.1, spool=spool, timeout=1000)
+    for i in range(25):
+        db.db_write('check', 'value', i)
+    db.flush()
+    print('server down: %d written, %d spooled' % (db.written, db.spooled))
+    assert db.written == 0 and db.spooled == 25
+    StandIn.status = 204
+    db.db_write('check', 'value', 25)
+    db.flush()
+    print('server back: %d lines received' % len(StandIn.received))
+    assert len(StandIn.received) == 26 and not os.path.exists(spool)
+    StandIn.status = 503
+    for i in range(5):
+        db.db_write('check', 'value', i)
+    start = time.time()
+    db.close(timeout=0.5)
+    print('close with the server down took %0.1f s, %d lines spooled' % (time.time() - start, db.spooled))
+    assert time.time() - start < 2 and db.spooled == 30
+    server.shutdown()